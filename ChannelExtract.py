@@ -2,6 +2,7 @@ import math
 import sys
 import os
 import json
+import threading
 import numpy as np
 import h5py
 from PyQt5.QtWidgets import (
@@ -23,18 +24,21 @@ from PyQt5.QtWidgets import (
     QSizePolicy,
     QGroupBox,
     QGridLayout,
+    QLineEdit,
 )
 from PyQt5.QtGui import QColor, QFont
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, pyqtSignal
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.widgets import LassoSelector
 from matplotlib.path import Path
-import matplotlib.image as mpimg
 import subprocess
 import qdarktheme
 
+from metadata_index import cached_properties, wav_frame_count
+from slice_images import SliceImage
+from trace_preview import SegmentCache
 
 SIZE = 30
 MARKER = "s"
@@ -45,11 +49,14 @@ class ScatterPlot(QWidget):
         super().__init__(parent)
         self.initUI()
         self.parent = parent
-        self.selected_points = []
+        # selection[row - 1, col - 1] is True for a selected electrode
+        self.selection = np.zeros((64, 64), dtype=bool)
         self.uploadedImage = uploadedImage
         self.undo_stack = []
         self.redo_stack = []
         self.setFocusPolicy(Qt.StrongFocus)
+        self.canvas.mpl_connect("motion_notify_event", self.onhover)
+        self.canvas.mpl_connect("button_press_event", self.onhover)
 
     def initUI(self):
         layout = QVBoxLayout()
@@ -89,57 +96,57 @@ class ScatterPlot(QWidget):
             self.parent.inputFileName
         ):
             return
-        path = Path(verts)
+        x, y = self.x, self.y
         if self.uploadedImage is not None:
             height, width, _ = self.uploadedImage.shape
-            new_selected_points = [
-                (x, y)
-                for x, y in zip(self.x, self.y)
-                if path.contains_point((x * width / 64, y * height / 64))
-            ]
-        else:
-            new_selected_points = [
-                (x, y) for x, y in zip(self.x, self.y) if path.contains_point((x, y))
-            ]
-
-        self.undo_stack.append(self.selected_points.copy())
-        self.redo_stack.clear()
-        self.selected_points.extend(new_selected_points)
-
-        self.update_selected_points_plot()
+            x, y = x * width / 64, y * height / 64
+        # x runs fastest in the flattened grid, so the hits reshape to (row, col)
+        inside = Path(verts).contains_points(np.column_stack((x, y)))
 
         verts = np.append(verts, [verts[0]], axis=0)
-        if hasattr(self, "lasso_line"):
-            self.lasso_line.remove()
+        self.removeArtist(getattr(self, "lasso_line", None))
         self.lasso_line = self.ax.plot(
             verts[:, 0], verts[:, 1], "b-", linewidth=1, alpha=0.8
         )[0]
 
+        self.setSelection(self.selection | inside.reshape(64, 64))
+
+    def setSelection(self, selection):
+        # the replaced selection is kept for undo, packed to 512 bytes
+        self.undo_stack.append(np.packbits(self.selection))
+        self.redo_stack.clear()
+        self.selection = selection
+        self.refreshSelection()
+
+    def refreshSelection(self):
+        self.update_selected_points_plot()
         self.canvas.draw()
         self.parent.updateChannelCount()
 
+    def removeArtist(self, artist):
+        # updateGrid clears the axes, which already took the old artists away
+        if artist is not None and artist.axes is not None:
+            artist.remove()
+
+    def selectedPoints(self, rowSkip=0, colSkip=0):
+        # (x, y) grid coordinates of the selection, keeping every (skip + 1)th
+        # row and column counted from 1
+        selection = np.zeros_like(self.selection)
+        selection[rowSkip :: rowSkip + 1, colSkip :: colSkip + 1] = self.selection[
+            rowSkip :: rowSkip + 1, colSkip :: colSkip + 1
+        ]
+        rows, cols = np.nonzero(selection)
+        return cols + 1, rows + 1
+
     def update_selected_points_plot(self):
-        if hasattr(self, "selected_points_plot"):
-            self.selected_points_plot.remove()
+        self.removeArtist(getattr(self, "selected_points_plot", None))
+        x, y = self.selectedPoints()
         if self.uploadedImage is not None:
             height, width, _ = self.uploadedImage.shape
-            self.selected_points_plot = self.ax.scatter(
-                [point[0] * width / 64 for point in self.selected_points],
-                [point[1] * height / 64 for point in self.selected_points],
-                c="red",
-                s=SIZE,
-                alpha=0.8,
-                marker=MARKER,
-            )
-        else:
-            self.selected_points_plot = self.ax.scatter(
-                [point[0] for point in self.selected_points],
-                [point[1] for point in self.selected_points],
-                c="red",
-                s=SIZE,
-                alpha=0.8,
-                marker=MARKER,
-            )
+            x, y = x * width / 64, y * height / 64
+        self.selected_points_plot = self.ax.scatter(
+            x, y, c="red", s=SIZE, alpha=0.8, marker=MARKER
+        )
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_C:
@@ -154,12 +161,7 @@ class ScatterPlot(QWidget):
         if self.lasso.active:
             self.lasso_line.set_visible(False)
             self.canvas.draw()
-        self.undo_stack.append(self.selected_points.copy())
-        self.redo_stack.clear()
-        self.selected_points.clear()
-        self.update_selected_points_plot()
-        self.canvas.draw()
-        self.parent.updateChannelCount()
+        self.setSelection(np.zeros_like(self.selection))
 
     def undo_selection(self):
         if self.undo_stack:
@@ -167,11 +169,9 @@ class ScatterPlot(QWidget):
                 self.lasso_line.set_visible(False)
                 self.canvas.draw()
 
-            self.redo_stack.append(self.selected_points.copy())
-            self.selected_points = self.undo_stack.pop()
-            self.update_selected_points_plot()
-            self.canvas.draw()
-            self.parent.updateChannelCount()
+            self.redo_stack.append(np.packbits(self.selection))
+            self.selection = self.unpack(self.undo_stack.pop())
+            self.refreshSelection()
 
     def redo_selection(self):
         if self.redo_stack:
@@ -179,11 +179,27 @@ class ScatterPlot(QWidget):
                 self.lasso_line.set_visible(False)
                 self.canvas.draw()
 
-            self.undo_stack.append(self.selected_points.copy())
-            self.selected_points = self.redo_stack.pop()
-            self.update_selected_points_plot()
-            self.canvas.draw()
-            self.parent.updateChannelCount()
+            self.undo_stack.append(np.packbits(self.selection))
+            self.selection = self.unpack(self.redo_stack.pop())
+            self.refreshSelection()
+
+    def unpack(self, snapshot):
+        return np.unpackbits(snapshot, count=64 * 64).astype(bool).reshape(64, 64)
+
+    def displaySize(self):
+        # device pixels along the longer side of the canvas
+        return int(
+            max(self.canvas.width(), self.canvas.height())
+            * self.canvas.devicePixelRatioF()
+        )
+
+    def onhover(self, event):
+        # the electrode under the mouse is previewed, except while a lasso is drawn
+        if self.parent is None or event.inaxes != self.ax:
+            return
+        if event.name == "motion_notify_event" and event.button is not None:
+            return
+        self.parent.previewElectrode(event.xdata, event.ydata)
 
     def onrelease(self, event):
         if self.lasso.active:
@@ -200,6 +216,148 @@ class ScatterPlot(QWidget):
         QMessageBox.information(self, "Plot Hotkeys", "\n".join(hotkeys))
 
 
+class PreviewSignals(QObject):
+    # key and envelope of a finished preview load, or the exception it raised
+    loaded = pyqtSignal(object, object)
+
+
+class PreviewTask(QRunnable):
+    def __init__(self, cache, key, parameters, signals):
+        super().__init__()
+        self.cache = cache
+        self.key = key
+        self.parameters = parameters
+        self.signals = signals
+
+    def run(self):
+        try:
+            segment = self.cache.load(self.key, self.parameters)
+        except Exception as e:
+            segment = e
+        self.signals.loaded.emit(self.key, segment)
+
+
+class ScanSignals(QObject):
+    # scan generation, recording and its (parameters, date/slice prefix, image),
+    # or the exception the scan raised
+    scanned = pyqtSignal(int, object, object)
+
+
+class ScanTask(QRunnable):
+    def __init__(self, scan, args, generation, signals):
+        super().__init__()
+        self.scan = scan
+        self.args = args
+        self.generation = generation
+        self.signals = signals
+
+    def run(self):
+        try:
+            result = self.scan(*self.args)
+        except Exception as e:
+            result = e
+        self.signals.scanned.emit(self.generation, self.args[1], result)
+
+
+class TracePreview(QWidget):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.parent = parent
+        self.cache = SegmentCache()
+        # one background reader, a newer request replaces any still queued
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.signals = PreviewSignals()
+        self.signals.loaded.connect(self.onLoaded)
+        self.request = None
+        self.key = None
+        self.initUI()
+
+    def initUI(self):
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+
+        controlsLayout = QHBoxLayout()
+        self.previewLabel = QLabel("Hover over an electrode to preview its trace")
+        self.previewLabel.setFont(QFont("Arial", 10))
+        controlsLayout.addWidget(self.previewLabel)
+        controlsLayout.addStretch()
+        controlsLayout.addWidget(QLabel("Preview Window (s):"))
+        self.windowSpinBox = QDoubleSpinBox()
+        self.windowSpinBox.setRange(0.01, 600)
+        self.windowSpinBox.setValue(2)
+        self.windowSpinBox.valueChanged.connect(self.refresh)
+        controlsLayout.addWidget(self.windowSpinBox)
+        layout.addLayout(controlsLayout)
+
+        fig = Figure(figsize=(5, 2), dpi=100)
+        fig.set_tight_layout(True)
+        self.canvas = FigureCanvas(fig)
+        self.canvas.setMinimumHeight(200)
+        layout.addWidget(self.canvas)
+        self.ax = fig.add_subplot(111)
+        self.canvas.draw()
+
+    def showElectrode(self, fileName, parameters, channel, row, col):
+        self.request = (fileName, parameters, channel, row, col)
+        self.refresh()
+
+    def refresh(self):
+        # only the frames of the preview window starting at the export start time
+        # are read
+        if self.request is None:
+            return
+        fileName, parameters, channel, row, col = self.request
+        fs = parameters["samplingRate"]
+        nFrames = int(parameters["nRecFrames"])
+        first = min(int(round(self.parent.startTimeSpinBox.value() * fs)), nFrames)
+        last = min(first + max(int(round(self.windowSpinBox.value() * fs)), 1), nFrames)
+        key = (fileName, int(channel), first, last)
+        if key == self.key:
+            return
+        self.key = key
+
+        segment = self.cache.get(key)
+        if segment is not None:
+            self.plot(segment)
+            return
+        self.previewLabel.setText(f"Loading electrode ({row}, {col})...")
+        self.pool.clear()
+        self.pool.start(PreviewTask(self.cache, key, parameters, self.signals))
+
+    def onLoaded(self, key, segment):
+        # loads for electrodes the mouse has already left stay cached but are not drawn
+        if key != self.key:
+            return
+        if isinstance(segment, Exception):
+            self.previewLabel.setText(f"Preview failed: {segment}")
+            return
+        self.plot(segment)
+
+    def plot(self, segment):
+        fileName, parameters, channel, row, col = self.request
+        _, _, first, last = self.key
+        fs = parameters["samplingRate"]
+        t = np.linspace(first / fs, last / fs, len(segment))
+
+        self.ax.clear()
+        self.ax.fill_between(t, segment[:, 0], segment[:, 1], color="tab:blue", lw=0.5)
+        self.ax.set_xlim(first / fs, last / fs)
+        self.ax.set_xlabel("Time (s)")
+        self.ax.set_ylabel("ADC counts")
+        self.canvas.draw_idle()
+        self.previewLabel.setText(
+            f"Electrode ({row}, {col}) of {os.path.basename(fileName)}"
+        )
+
+    def clear(self):
+        self.request = None
+        self.key = None
+        self.ax.clear()
+        self.canvas.draw_idle()
+        self.previewLabel.setText("Hover over an electrode to preview its trace")
+
+
 class ChannelExtract(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -229,6 +387,17 @@ class ChannelExtract(QMainWindow):
         self.previously_selected_row = None
         self.theme = "dark"
         self.last_exported_selection = None
+        self.imageDict = {}
+
+        # folder scans run in their own pool so the window stays responsive
+        self.scanPool = QThreadPool()
+        self.scanSignals = ScanSignals()
+        self.scanSignals.scanned.connect(self.onScanned)
+        self.scanGeneration = 0
+        self.scanPending = 0
+        self.missingImages = []
+        # get_type and parameter pass the file type through self.typ
+        self.parseLock = threading.Lock()
 
         self.showMaximized()
 
@@ -330,6 +499,12 @@ class ChannelExtract(QMainWindow):
         settingsLayout.addWidget(downsampleLabel)
         settingsLayout.addWidget(self.downsampleSpinBox)
 
+        extraRatesLabel = QLabel("Extra Rates (Hz, comma separated):")
+        self.extraRatesEdit = QLineEdit()
+        self.extraRatesEdit.setPlaceholderText("e.g. 2000, 1000")
+        settingsLayout.addWidget(extraRatesLabel)
+        settingsLayout.addWidget(self.extraRatesEdit)
+
         startTimeLabel = QLabel("Start Time (s):")
         self.startTimeSpinBox = QDoubleSpinBox()
         self.startTimeSpinBox.setRange(0, 100000)
@@ -370,6 +545,11 @@ class ChannelExtract(QMainWindow):
         )
         gridLayout.addWidget(self.outputGridWidget, 0, 2)
 
+        # Create trace preview for the electrode under the mouse
+        self.tracePreview = TracePreview(self)
+        self.startTimeSpinBox.valueChanged.connect(self.tracePreview.refresh)
+        gridLayout.addWidget(self.tracePreview, 1, 0, 1, 3)
+
         groupBox.setLayout(gridLayout)
         self.channelSelectionLayout.addWidget(groupBox)
 
@@ -392,18 +572,10 @@ class ChannelExtract(QMainWindow):
         self.mainLayout.addWidget(splitter)
 
     def updateChannelCount(self):
-        selectedPoints = self.inputGridWidget.selected_points
-        if selectedPoints:
-            row_step = self.rowSkipSpinBox.value()
-            col_step = self.colSkipSpinBox.value()
-
-            channel_count = sum(
-                1
-                for x, y in selectedPoints
-                if y % (row_step + 1) == 0 and x % (col_step + 1) == 0
-            )
-
-            self.channelCountLabel.setText(f"Channel Count: {channel_count}")
+        x, _ = self.inputGridWidget.selectedPoints(
+            self.rowSkipSpinBox.value(), self.colSkipSpinBox.value()
+        )
+        self.channelCountLabel.setText(f"Channel Count: {len(x)}")
 
     def uploadFiles(self):
         options = QFileDialog.Options()
@@ -412,104 +584,151 @@ class ChannelExtract(QMainWindow):
         )
 
         if self.folderName:
-            tableData = []
             self.imageDict = {}
+            self.dataTable.setRowCount(0)
+            self.previously_selected_row = None
+
+            # the folder is listed once, the tasks look images up in it
+            folderFiles = os.listdir(self.folderName)
+            brwFiles = [
+                f
+                for f in folderFiles
+                if f.endswith(".brw") and "resample" not in f and "exportCh" not in f
+            ]
 
-            brwFiles = [f for f in os.listdir(self.folderName) if f.endswith(".brw")]
-
+            # results of an earlier scan that is still running are dropped
+            self.scanGeneration += 1
+            self.scanPool.clear()
+            self.scanPending = len(brwFiles)
+            self.missingImages = []
+            self.statusBar().showMessage(f"Scanning {len(brwFiles)} files...")
             for brwFile in brwFiles:
-                try:
-                    fileName = os.path.join(self.folderName, brwFile)
-                    fileName = os.path.normpath(fileName)
-                    if fileName.__contains__("resample") or fileName.__contains__(
-                        "exportCh"
-                    ):
-                        continue
-                    h5 = h5py.File(fileName, "r")
-                    self.get_type(h5)
-                    parameters = self.parameter(h5)
-                except Exception as e:
-                    print(f"Error reading file {brwFile}: {str(e)}")
-                    continue
-                chsList = parameters["recElectrodeList"]
-                filePath = self.folderName
-                baseName = os.path.basename(fileName)
-                dateSlice = "_".join(baseName.split("_")[:4])
-                dateSliceNumber = (
-                    dateSlice.split("slice")[0]
-                    + "slice"
-                    + dateSlice.split("slice")[1][:1]
-                )
-                imageName = f"{dateSliceNumber}_pic_cropped.jpg".lower()
-                imageFolder = self.folderName
-                imagePath = os.path.join(imageFolder, imageName)
-
-                if os.path.exists(imagePath):
-                    image = mpimg.imread(imagePath)
-                else:
-                    imageFiles = [
-                        f for f in os.listdir(imageFolder) if f.lower() == imageName
-                    ]
-                    if imageFiles:
-                        imagePath = os.path.join(imageFolder, imageFiles[0])
-                        image = mpimg.imread(imagePath)
-                    else:
-                        msg = QMessageBox()
-                        msg.setIcon(QMessageBox.Information)
-                        msg.setText(
-                            f"No image found, manually select image for {baseName}"
-                        )
-                        msg.setWindowTitle("Image Not Found")
-                        msg.exec_()
-                        imageFileName, _ = QFileDialog.getOpenFileName(
-                            self,
-                            "Upload Slice Image",
-                            "",
-                            "Image Files (*.jpg *.png)",
-                            options=options,
-                        )
-                        if imageFileName:
-                            image = mpimg.imread(imageFileName)
-                        else:
-                            image = None
-
-                self.imageDict[fileName] = image
-
-                tableData.append(
-                    [
-                        filePath,
-                        baseName,
-                        parameters["Ver"],
-                        parameters["Typ"],
-                        len(chsList),
-                        parameters["nRecFrames"],
-                        round(parameters["nRecFrames"] / parameters["samplingRate"]),
-                        parameters["samplingRate"],
-                        "Not Exported",
-                        QPushButton("Select"),
-                    ]
+                fileName = os.path.normpath(os.path.join(self.folderName, brwFile))
+                self.scanPool.start(
+                    ScanTask(
+                        self.scanRecording,
+                        (self.folderName, fileName, folderFiles),
+                        self.scanGeneration,
+                        self.scanSignals,
+                    )
                 )
+            if not brwFiles:
+                self.statusBar().showMessage("No recordings found")
 
-                h5.close()
+    def scanRecording(self, folderName, fileName, folderFiles):
+        # runs in the scan pool, everything here must stay off the widgets
+        parameters = self.recordingParameters(fileName)
+        baseName = os.path.basename(fileName)
+        try:
+            dateSlice = "_".join(baseName.split("_")[:4])
+            dateSliceNumber = (
+                dateSlice.split("slice")[0] + "slice" + dateSlice.split("slice")[1][:1]
+            )
+        except IndexError:
+            return parameters, None, None
+        imageName = f"{dateSliceNumber}_pic_cropped.jpg".lower()
+
+        imageFiles = [f for f in folderFiles if f.lower() == imageName]
+        if not imageFiles:
+            return parameters, dateSliceNumber, None
+        # only the header is read here, the pixels are decoded when drawn
+        return (
+            parameters,
+            dateSliceNumber,
+            SliceImage(os.path.join(folderName, imageFiles[0])),
+        )
 
-            self.populateTable(tableData)
+    def onScanned(self, generation, fileName, result):
+        if generation != self.scanGeneration:
+            return
+        self.scanPending -= 1
+        if isinstance(result, Exception):
+            print(f"Error reading file {os.path.basename(fileName)}: {str(result)}")
+        else:
+            parameters, dateSliceNumber, image = result
+            self.imageDict[fileName] = image
+            if image is None:
+                self.missingImages.append((fileName, dateSliceNumber))
+            self.appendTableRow(
+                [
+                    os.path.dirname(fileName),
+                    os.path.basename(fileName),
+                    parameters["Ver"],
+                    parameters["Typ"],
+                    len(parameters["recElectrodeList"]),
+                    parameters["nRecFrames"],
+                    round(parameters["nRecFrames"] / parameters["samplingRate"]),
+                    parameters["samplingRate"],
+                    "Not Exported",
+                    QPushButton("Select"),
+                ]
+            )
+            self.dataTable.resizeColumnsToContents()
 
-    def populateTable(self, data):
-        self.dataTable.setRowCount(len(data))
-        for i, row in enumerate(data):
-            for j, item in enumerate(row):
-                if isinstance(item, QPushButton):
-                    self.dataTable.setCellWidget(i, j, item)
-                    item.clicked.connect(lambda _, r=i: self.selectFile(r))
-                else:
-                    table_item = QTableWidgetItem(str(item))
-                    table_item.setFlags(table_item.flags() & ~Qt.ItemIsEditable)
-                    table_item.setTextAlignment(Qt.AlignCenter)
-                    if j == len(row) - 2:
-                        table_item.setBackground(QColor("#bc4749"))
-                    self.dataTable.setItem(i, j, table_item)
+        if self.scanPending > 0:
+            self.statusBar().showMessage(f"Scanning... {self.scanPending} files left")
+            return
+        self.statusBar().showMessage(f"{self.dataTable.rowCount()} recordings loaded")
+        if self.missingImages:
+            self.resolveMissingImages()
+
+    def resolveMissingImages(self):
+        # one prompt for every recording without a slice image, picked images are
+        # matched to recordings by their date and slice prefix
+        names = "\n".join(os.path.basename(f) for f, _ in self.missingImages)
+        reply = QMessageBox.question(
+            self,
+            "Images Not Found",
+            f"No image found for {len(self.missingImages)} recordings:\n{names}\n\n"
+            "Select their slice images now?",
+            QMessageBox.Yes | QMessageBox.No,
+            QMessageBox.Yes,
+        )
+        if reply != QMessageBox.Yes:
+            return
+        imageFileNames, _ = QFileDialog.getOpenFileNames(
+            self,
+            "Upload Slice Images",
+            self.folderName,
+            "Image Files (*.jpg *.png)",
+        )
+        for fileName, dateSliceNumber in self.missingImages:
+            if len(self.missingImages) == 1 and len(imageFileNames) == 1:
+                matches = imageFileNames
+            else:
+                matches = [
+                    f
+                    for f in imageFileNames
+                    if dateSliceNumber
+                    and os.path.basename(f).lower().startswith(dateSliceNumber.lower())
+                ]
+            if matches:
+                self.imageDict[fileName] = SliceImage(matches[0])
+        unmatched = [
+            os.path.basename(f)
+            for f, _ in self.missingImages
+            if self.imageDict.get(f) is None
+        ]
+        self.missingImages = []
+        if unmatched:
+            self.statusBar().showMessage(
+                f"No image matched for: {', '.join(unmatched)}"
+            )
 
-        self.dataTable.resizeColumnsToContents()
+    def appendTableRow(self, row):
+        i = self.dataTable.rowCount()
+        self.dataTable.insertRow(i)
+        for j, item in enumerate(row):
+            if isinstance(item, QPushButton):
+                self.dataTable.setCellWidget(i, j, item)
+                item.clicked.connect(lambda _, r=i: self.selectFile(r))
+            else:
+                table_item = QTableWidgetItem(str(item))
+                table_item.setFlags(table_item.flags() & ~Qt.ItemIsEditable)
+                table_item.setTextAlignment(Qt.AlignCenter)
+                if j == len(row) - 2:
+                    table_item.setBackground(QColor("#bc4749"))
+                self.dataTable.setItem(i, j, table_item)
 
     def selectFile(self, row):
         fileName = os.path.join(
@@ -518,6 +737,7 @@ class ChannelExtract(QMainWindow):
         fileName = os.path.normpath(fileName)
         self.inputFileName = fileName
         self.uploadedImage = self.imageDict.get(fileName)
+        self.tracePreview.clear()
         self.updateGrid()
 
         if (
@@ -532,15 +752,10 @@ class ChannelExtract(QMainWindow):
             False
         )
 
-        if self.inputGridWidget.selected_points:
-            self.inputGridWidget.selected_points = []
-            self.inputGridWidget.undo_stack.append(
-                self.inputGridWidget.selected_points.copy()
+        if self.inputGridWidget.selection.any():
+            self.inputGridWidget.setSelection(
+                np.zeros_like(self.inputGridWidget.selection)
             )
-            self.inputGridWidget.redo_stack.clear()
-            self.inputGridWidget.update_selected_points_plot()
-            self.inputGridWidget.canvas.draw()
-            self.updateChannelCount()
 
         self.outputGridWidget.ax.clear()
         self.outputGridWidget.canvas.draw()
@@ -550,9 +765,7 @@ class ChannelExtract(QMainWindow):
 
     def updateGrid(self):
         if self.inputFileName and os.path.exists(self.inputFileName):
-            h5 = h5py.File(self.inputFileName, "r")
-            self.get_type(h5)
-            parameters = self.parameter(h5)
+            parameters = self.recordingParameters(self.inputFileName)
             chsList = parameters["recElectrodeList"]
             endTime = parameters["recordingLength"]
 
@@ -572,12 +785,13 @@ class ChannelExtract(QMainWindow):
 
                 # Display the image and set the x and y limits based on the image dimensions
                 self.inputGridWidget.ax.imshow(
-                    self.uploadedImage, extent=[0, width, height, 0]
+                    self.uploadedImage.pixels(self.inputGridWidget.displaySize()),
+                    extent=[0, width, height, 0],
                 )
 
                 # Scale the grid coordinates to match the image dimensions
-                Xs = [x * width / 64 for x in Xs]
-                Ys = [y * height / 64 for y in Ys]
+                Xs = [int(x) * width / 64 for x in Xs]
+                Ys = [int(y) * height / 64 for y in Ys]
 
                 self.inputGridWidget.ax.set_xlim(0, width)
                 self.inputGridWidget.ax.set_ylim(height, 0)
@@ -597,49 +811,49 @@ class ChannelExtract(QMainWindow):
 
             self.endTimeSpinBox.setRange(0, endTime)
             self.endTimeSpinBox.setValue(endTime)
-
-            h5.close()
         else:
             self.statusBar().showMessage("No .brw file selected")
 
             self.inputGridWidget.ax.clear()
             self.inputGridWidget.canvas.draw()
 
+    def previewElectrode(self, x, y):
+        if not self.inputFileName or not os.path.exists(self.inputFileName):
+            return
+        if self.uploadedImage is not None:
+            height, width, _ = self.uploadedImage.shape
+            x, y = x * 64 / width, y * 64 / height
+        # same (Row, Col) convention as the exported channel list
+        row, col = int(round(y)), int(round(x))
+        if not (1 <= row <= 64 and 1 <= col <= 64):
+            return
+        parameters = self.recordingParameters(self.inputFileName)
+        chsList = parameters["recElectrodeList"]
+        channel = np.flatnonzero((chsList["Row"] == row) & (chsList["Col"] == col))
+        if len(channel):
+            self.tracePreview.showElectrode(
+                self.inputFileName, parameters, channel[0], row, col
+            )
+
     def restoreSelection(self):
-        if self.last_exported_selection:
-            self.inputGridWidget.selected_points = self.last_exported_selection.copy()
-            self.inputGridWidget.update_selected_points_plot()
-            self.inputGridWidget.canvas.draw()
-            self.updateChannelCount()
+        if self.last_exported_selection is not None:
+            self.inputGridWidget.setSelection(self.last_exported_selection.copy())
             self.statusBar().showMessage("Previous selection restored")
         else:
             self.statusBar().showMessage("No previous selection to restore")
 
     def exportChannels(self):
-        selectedPoints = None
-        try:
-            selectedPoints = self.inputGridWidget.selected_points
-        except Exception:
-            print("No points selected")
-            return
-        if selectedPoints:
-            self.last_exported_selection = selectedPoints.copy()
-            chX = []
-            chY = []
-            for point in selectedPoints:
-                x, y = point
-                if (
-                    round(y) % (self.rowSkipSpinBox.value() + 1) == 0
-                    and round(x) % (self.colSkipSpinBox.value() + 1) == 0
-                ):
-                    chX.append(x)
-                    chY.append(y)
-
-            h5 = h5py.File(self.inputFileName, "r")
-            parameters = self.parameter(h5)
+        selection = self.inputGridWidget.selection
+        if selection.any():
+            self.last_exported_selection = selection.copy()
+            cols, rows = self.inputGridWidget.selectedPoints(
+                self.rowSkipSpinBox.value(), self.colSkipSpinBox.value()
+            )
+            chX, chY = cols, rows
+
+            parameters = self.recordingParameters(self.inputFileName)
             chsList = parameters["recElectrodeList"]
             xs, ys, idx = self.getChMap(chsList)
-            h5.close()
 
             self.outputGridWidget.ax.clear()
             self.outputGridWidget.uploadedImage = (
@@ -654,14 +868,15 @@ class ChannelExtract(QMainWindow):
 
                 # Display the image and set the x and y limits based on the image dimensions
                 self.outputGridWidget.ax.imshow(
-                    self.uploadedImage, extent=[0, width, height, 0]
+                    self.uploadedImage.pixels(self.outputGridWidget.displaySize()),
+                    extent=[0, width, height, 0],
                 )
 
                 # Scale the grid coordinates to match the image dimensions
-                xs = [x * width / 64 for x in xs]
-                ys = [y * height / 64 for y in ys]
-                chX = [x * width / 64 for x in chX]
-                chY = [y * height / 64 for y in chY]
+                xs = [int(x) * width / 64 for x in xs]
+                ys = [int(y) * height / 64 for y in ys]
+                chX = cols * width / 64
+                chY = rows * height / 64
 
                 self.outputGridWidget.ax.set_xlim(0, width)
                 self.outputGridWidget.ax.set_ylim(height, 0)
@@ -685,14 +900,10 @@ class ChannelExtract(QMainWindow):
             self.outputGridWidget.ax.invert_yaxis()
             self.outputGridWidget.canvas.draw()
 
-            newChs = np.zeros(len(chX), dtype=[("Row", "<i2"), ("Col", "<i2")])
-            for idx, (x, y) in enumerate(zip(chX, chY)):
-                if self.uploadedImage is not None:
-                    newChs[idx] = (np.int16(y * 64 / height), np.int16(x * 64 / width))
-                else:
-                    newChs[idx] = (np.int16(y), np.int16(x))
-
-            newChs = newChs[np.lexsort((newChs["Col"], newChs["Row"]))]
+            # one entry per selected electrode, already in (Row, Col) order
+            newChs = np.zeros(len(rows), dtype=[("Row", "<i2"), ("Col", "<i2")])
+            newChs["Row"] = rows
+            newChs["Col"] = cols
 
             inputFilePath = os.path.dirname(self.inputFileName)
             inputFileName = os.path.basename(self.inputFileName)
@@ -709,7 +920,7 @@ class ChannelExtract(QMainWindow):
                 parameters["nRecFrames"],
                 newChs,
                 parameters["samplingRate"],
-                self.downsampleSpinBox.value(),
+                self.targetRates(),
                 self.startTimeSpinBox.value(),
                 self.endTimeSpinBox.value(),
             )
@@ -726,6 +937,20 @@ class ChannelExtract(QMainWindow):
 
             self.statusBar().showMessage("Channels exported successfully")
 
+    def targetRates(self):
+        # the spin box rate comes first, every extra rate gets its own output file.
+        # The files are named after the whole Hz, so a rate that would share one
+        # with an earlier rate is left out.
+        rates = [self.downsampleSpinBox.value()]
+        for text in self.extraRatesEdit.text().replace(";", ",").split(","):
+            try:
+                rate = float(text)
+            except ValueError:
+                continue
+            if rate > 0 and int(rate) not in [int(r) for r in rates]:
+                rates.append(rate)
+        return rates
+
     def runDownsampleExport(self):
         home_dir = os.path.expanduser("~")
         local_path = os.path.join(home_dir, "ChannelExtract")
@@ -799,6 +1024,15 @@ class ChannelExtract(QMainWindow):
         ]
         run_commands_in_terminal(commands)
 
+    def recordingParameters(self, fileName):
+        # the file is only parsed when it is new or has changed since it was indexed
+        def read():
+            with h5py.File(fileName, "r") as h5, self.parseLock:
+                self.get_type(h5)
+                return self.parameter(h5)
+
+        return cached_properties(fileName, "recording", read)
+
     def get_type(self, h5):
         if "ExperimentSettings" in h5.keys():
             self.typ = "bw5"
@@ -828,7 +1062,7 @@ class ChannelExtract(QMainWindow):
                 0
             ]  # number of used bit of the 2 byte coding
             parameters["qLevel"] = (
-                2 ^ parameters["bitDepth"]
+                2 ** parameters["bitDepth"]
             )  # quantized levels corresponds to 2^num of bit to encode the signal
             parameters["fromQLevelToUVolt"] = (
                 parameters["maxUVolt"] - parameters["minUVolt"]
@@ -864,7 +1098,7 @@ class ChannelExtract(QMainWindow):
                 # number of used bit of the 2 byte coding
                 parameters["bitDepth"] = int(12)
                 parameters["qLevel"] = (
-                    2 ^ parameters["bitDepth"]
+                    2 ** parameters["bitDepth"]
                 )  # quantized levels corresponds to 2^num of bit to encode the signal
                 parameters["fromQLevelToUVolt"] = (
                     parameters["maxUVolt"] - parameters["minUVolt"]
@@ -891,15 +1125,9 @@ class ChannelExtract(QMainWindow):
                 coefsChunkLength = (
                     math.ceil(framesChunkLength / pow(2, compressionLevel)) * 2
                 )
-                numFrames = 0
-                chIdx = 1
-                coefsPosition = chIdx * coefsChunkLength
-                while coefsPosition < coefsTotalLength:
-                    length = int(coefsChunkLength / 2)
-                    for i in range(compressionLevel):
-                        length *= 2
-                    numFrames += length
-                    coefsPosition += coefsChunkLength * nChannels
+                numFrames = wav_frame_count(
+                    coefsTotalLength, nChannels, coefsChunkLength, compressionLevel
+                )
 
                 parameters["nRecFrames"] = numFrames
                 parameters["recordingLength"] = numFrames / samplingRate
@@ -913,7 +1141,7 @@ class ChannelExtract(QMainWindow):
                 # number of used bit of the 2 byte coding
                 parameters["bitDepth"] = int(12)
                 parameters["qLevel"] = (
-                    2 ^ parameters["bitDepth"]
+                    2 ** parameters["bitDepth"]
                 )  # quantized levels corresponds to 2^num of bit to encode the signal
                 parameters["fromQLevelToUVolt"] = (
                     parameters["maxUVolt"] - parameters["minUVolt"]
@@ -1020,7 +1248,8 @@ class writeCBrw:
             "/3BRecInfo/3BRecVars/SamplingRate", data=[np.float64(fs)]
         )
         brwAppend.create_dataset(
-            "/3BRecInfo/3BRecVars/NewSampling", data=[np.float64(NewSampling)]
+            "/3BRecInfo/3BRecVars/NewSampling",
+            data=np.atleast_1d(np.float64(NewSampling)),
         )
         brwAppend.create_dataset(
             "/3BRecInfo/3BRecVars/startTime", data=[np.float64(ss)]
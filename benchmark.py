@@ -0,0 +1,313 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import export_to_brw
+from export_to_brw import getChMap, writeBrw
+from synthetic_brw import FORMATS, synthetic_signal, write_exportCh
+
+try:
+    import resource
+except ImportError:  # Windows, peak memory is not reported there
+    resource = None
+
+# storage settings compared by default, each one overrides EXPORT_OPTIONS
+STORAGE_SETTINGS = [
+    {},
+    {"chunk_frames": 1000},
+    {"chunk_frames": 10000},
+    {"chunk_frames": 10000, "compression": "lzf"},
+    {"chunk_frames": 10000, "compression": "lzf", "shuffle": True},
+    {
+        "chunk_frames": 10000,
+        "compression": "gzip",
+        "compression_opts": 1,
+        "shuffle": True,
+    },
+    {
+        "chunk_frames": 10000,
+        "compression": "gzip",
+        "compression_opts": 4,
+        "shuffle": True,
+    },
+    {"raw_layout": "channels"},
+    {"raw_layout": "channels", "compression": "lzf", "shuffle": True},
+]
+
+
+def synthetic_parameters(nChannels, samplingRate):
+    parameters = {}
+    parameters["Ver"] = "BW5"
+    parameters["Typ"] = "RAW"
+    parameters["samplingRate"] = samplingRate
+    parameters["nRecFrames"] = 0
+    parameters["signalInversion"] = 1
+    parameters["maxUVolt"] = 4125
+    parameters["minUVolt"] = -4125
+    parameters["bitDepth"] = 12
+    parameters["recElectrodeList"] = getChMap()[:nChannels]
+    return parameters
+
+
+def benchmark_storage(
+    nChannels, nFrames, settings=STORAGE_SETTINGS, folder=None, block_frames=10000
+):
+    data = synthetic_signal(nChannels, nFrames)
+    parameters = synthetic_parameters(nChannels, 300.0)
+    rawBytes = data.nbytes
+    results = []
+
+    for setting in settings:
+        fd, path = tempfile.mkstemp(suffix=".brw", dir=folder)
+        os.close(fd)
+        try:
+            s = time.time()
+            # the envelope would add the same levels to every setting, the sizes
+            # and ratios compare the storage of Raw alone
+            dset = writeBrw(path, path, parameters, dict(setting, envelope_factor=None))
+            dset.createNewBrw()
+            dset.allocateRaw(nChannels, nFrames)
+            for start in range(0, nFrames, block_frames):
+                dset.writeRaw(data[:, start : start + block_frames], typeFlatten="F")
+            dset.writeSamplingFreq(parameters["samplingRate"])
+            dset.witeFrames(nFrames)
+            dset.writeChs(parameters["recElectrodeList"])
+            dset.close()
+            writeTime = time.time() - s
+
+            with h5py.File(path, "r") as h5:
+                s = time.time()
+                h5["/3BData/Raw"][:]
+                readTime = time.time() - s
+
+                # a single channel is a strided read over the frame-interleaved
+                # stream and one row of a channel-major one
+                s = time.time()
+                if h5["/3BData/Raw"].ndim == 2:
+                    h5["/3BData/Raw"][nChannels // 2]
+                else:
+                    h5["/3BData/Raw"][nChannels // 2 :: nChannels]
+                channelTime = time.time() - s
+
+            results.append(
+                {
+                    "setting": setting,
+                    "write_MBps": rawBytes / 1e6 / writeTime,
+                    "file_MB": os.path.getsize(path) / 1e6,
+                    "ratio": rawBytes / os.path.getsize(path),
+                    "read_MBps": rawBytes / 1e6 / readTime,
+                    "channel_read_ms": channelTime * 1000,
+                }
+            )
+        finally:
+            os.remove(path)
+
+    return results
+
+
+def describe(setting):
+    if not setting:
+        return "h5py default"
+    return ", ".join(f"{key}={value}" for key, value in setting.items())
+
+
+def print_storage_table(results):
+    header = f"{'setting':<72} {'write MB/s':>10} {'size MB':>8} {'ratio':>6} {'read MB/s':>10} {'1 ch ms':>8}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{describe(result['setting']):<72} {result['write_MBps']:>10.1f} "
+            f"{result['file_MB']:>8.1f} {result['ratio']:>6.2f} "
+            f"{result['read_MBps']:>10.1f} {result['channel_read_ms']:>8.1f}"
+        )
+
+
+def peak_rss_MB(who):
+    if resource is None:
+        return None
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1e6 if os.uname().sysname == "Darwin" else 1e3
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+def extract_case(queue, chfileName, recfileName, options):
+    # runs in a fresh process so the peak RSS belongs to this extraction only
+    chfileInfo = export_to_brw.get_chfile_properties(chfileName)
+    parameters = export_to_brw.get_recFile_properties(
+        recfileName, chfileInfo["Ver"].lower()
+    )
+    extract = export_to_brw.get_extractor(chfileInfo)
+    s = time.time()
+    totTime, output_paths = extract(
+        chfileName, recfileName, chfileInfo, parameters, options
+    )
+    queue.put(
+        {
+            "seconds": time.time() - s,
+            "parent_rss_MB": peak_rss_MB(resource and resource.RUSAGE_SELF),
+            "worker_rss_MB": peak_rss_MB(resource and resource.RUSAGE_CHILDREN),
+            "output_paths": output_paths,
+        }
+    )
+
+
+def source_bytes(recfileName, Ver, Typ):
+    # size of the sample stream the extractor reads from
+    dataset = {
+        ("BW4", "RAW"): "/3BData/Raw",
+        ("BW4", "WAV"): "/3BData/WaveletCoefficients",
+        ("BW5", "RAW"): "Well_A1/Raw",
+        ("BW5", "WAV"): "Well_A1/WaveletBasedEncodedRaw",
+    }[(Ver, Typ)]
+    with h5py.File(recfileName, "r") as h5:
+        return h5[dataset].nbytes
+
+
+def benchmark_extractors(
+    formats=tuple(FORMATS),
+    channel_counts=(64, 1024, 4096),
+    durations=(2.0,),
+    samplingRate=20000.0,
+    newSampling=300.0,
+    folder=None,
+    options=None,
+):
+    results = []
+    context = multiprocessing.get_context("spawn")
+    chMap = getChMap()
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        for name in formats:
+            write, Ver, Typ = FORMATS[name]
+            for duration in durations:
+                nFrames = int(duration * samplingRate)
+                recfileName = os.path.join(tmp, f"synthetic_{name}.brw")
+                # written from a child as well, Linux carries a parent's peak RSS
+                # over into the processes it starts
+                process = context.Process(
+                    target=write,
+                    args=(recfileName, nFrames),
+                    kwargs={"samplingRate": samplingRate},
+                )
+                process.start()
+                process.join()
+                nBytes = source_bytes(recfileName, Ver, Typ)
+
+                for nChannels in channel_counts:
+                    # spread over the chip like a row/column skip selection
+                    chs = chMap[np.linspace(0, len(chMap) - 1, nChannels).astype(int)]
+                    chfileName = os.path.join(tmp, f"synthetic_{name}_exportCh.brw")
+                    write_exportCh(
+                        chfileName,
+                        chs,
+                        Ver.encode(),
+                        Typ.encode(),
+                        nFrames,
+                        samplingRate,
+                        newSampling,
+                    )
+
+                    queue = context.Queue()
+                    process = context.Process(
+                        target=extract_case,
+                        args=(queue, chfileName, recfileName, options),
+                    )
+                    process.start()
+                    case = queue.get()
+                    process.join()
+                    for path in case.pop("output_paths"):
+                        os.remove(path)
+
+                    case.update(
+                        {
+                            "format": name,
+                            "channels": nChannels,
+                            "duration_s": duration,
+                            "source_MB": nBytes / 1e6,
+                            "MBps": nBytes / 1e6 / case["seconds"],
+                            "frames_per_s": nFrames / case["seconds"],
+                        }
+                    )
+                    results.append(case)
+                os.remove(recfileName)
+
+    return results
+
+
+def print_extract_table(results):
+    header = f"{'format':<8} {'channels':>8} {'dur s':>6} {'source MB':>9} {'MB/s':>8} {'frames/s':>10} {'RSS MB':>7} {'worker MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        rss = [
+            f"{result[key]:.0f}" if result[key] is not None else "-"
+            for key in ("parent_rss_MB", "worker_rss_MB")
+        ]
+        print(
+            f"{result['format']:<8} {result['channels']:>8} "
+            f"{result['duration_s']:>6.1f} {result['source_MB']:>9.1f} "
+            f"{result['MBps']:>8.1f} {result['frames_per_s']:>10.0f} "
+            f"{rss[0]:>7} {rss[1]:>9}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the storage settings of the _resample_ output files "
+        "and the extractors on synthetic recordings"
+    )
+    parser.add_argument(
+        "--suite", choices=["storage", "extract", "all"], default="storage"
+    )
+    parser.add_argument("--channels", type=int, default=1024)
+    parser.add_argument("--frames", type=int, default=300 * 60)
+    parser.add_argument(
+        "--formats", nargs="+", choices=list(FORMATS), default=list(FORMATS)
+    )
+    parser.add_argument(
+        "--select",
+        type=int,
+        nargs="+",
+        default=[64, 1024, 4096],
+        help="exported channel counts for the extract suite",
+    )
+    parser.add_argument(
+        "--durations",
+        type=float,
+        nargs="+",
+        default=[2.0],
+        help="recording lengths in seconds for the extract suite",
+    )
+    parser.add_argument("--rate", type=float, default=20000.0)
+    parser.add_argument("--new-rate", type=float, default=300.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--dir", default=None, help="folder to write the test files to")
+    parser.add_argument("--json", default=None, help="also save the results here")
+    args = parser.parse_args()
+
+    results = {}
+    if args.suite in ("storage", "all"):
+        results["storage"] = benchmark_storage(
+            args.channels, args.frames, folder=args.dir
+        )
+        print_storage_table(results["storage"])
+    if args.suite in ("extract", "all"):
+        results["extract"] = benchmark_extractors(
+            args.formats,
+            args.select,
+            args.durations,
+            args.rate,
+            args.new_rate,
+            folder=args.dir,
+            options={"workers": args.workers},
+        )
+        print_extract_table(results["extract"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,33 @@
+import collections
+import threading
+
+
+class ByteCache:
+    """Arrays kept by key until their total size passes max_bytes.
+
+    The least recently used arrays are dropped first, the newest one is always
+    kept. get() and put() may be called from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, oldest = self.entries.popitem(last=False)
+                self.nbytes -= oldest.nbytes
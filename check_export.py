@@ -0,0 +1,334 @@
+import argparse
+import contextlib
+import gc
+import os
+import tempfile
+
+import h5py
+import numpy as np
+import pywt
+import scipy.signal
+
+import export_to_brw
+from export_to_brw import StreamResampler, getChMap
+from synthetic_brw import FORMATS, write_exportCh
+
+# Consistency checks of the export pipeline on small synthetic recordings, to run
+# after changing the resampler, the WAV decoder, the windowing or the resume
+# checkpoints. Each check raises AssertionError on the first mismatch.
+
+# resampling ratios and block sizes StreamResampler is compared with resample_poly on
+RESAMPLER_CASES = [
+    (20000.0, 2000.0, 777),
+    (10000.0, 300.0, 5000),
+    (17855.5, 300.0, 100000),
+    (10000.0, 10000.0, 333),
+    (9000.0, 12000.0, 1001),
+    (20000.0, 1024.0, 64),
+]
+
+# full-rate frames of the synthetic recordings, and the exported part in seconds
+CHECK_FRAMES = 12000
+CHECK_START, CHECK_END = 0.05, 0.55
+CHECK_RATES = [300.0, 2000.0]
+
+# window small enough that every export runs through several windows
+CHECK_WINDOW_FRAMES = 2000
+
+
+class SimulatedCrash(RuntimeError):
+    pass
+
+
+def check_resampler(cases=RESAMPLER_CASES, seed=0):
+    rng = np.random.default_rng(seed)
+    for samplingRate, newSampling, blockFrames in cases:
+        x = rng.standard_normal((3, 250000))
+        resampler = StreamResampler(samplingRate, newSampling, 3)
+        out = [
+            resampler.process(x[:, i : i + blockFrames])
+            for i in range(0, x.shape[1], blockFrames)
+        ]
+        out = np.concatenate(out + [resampler.flush()], axis=1)
+        ref = scipy.signal.resample_poly(x, resampler.up, resampler.down, axis=1)
+        assert out.shape == ref.shape, (samplingRate, newSampling, out.shape)
+        # the streamed filter runs in float32
+        error = np.abs(out - ref).max()
+        assert error < 1e-5, (samplingRate, newSampling, error)
+        print(f"resampler {samplingRate} -> {newSampling} Hz: max error {error:.1e}")
+
+
+def per_chunk_decode(h5, dataset, channel, layout):
+    # the chunk by chunk float64 decode of one channel the exporter used to run,
+    # kept as the reference for the bulk decoders
+    data = []
+    coefsChunkLength = layout["coefsChunkLength"]
+    position = channel * coefsChunkLength
+    while position < layout["numChunks"] * layout["coefsBlockLength"]:
+        coefs = h5[dataset][position : position + coefsChunkLength]
+        length = int(len(coefs) / 2)
+        approx = np.roll(coefs[:length], -5)
+        details = np.roll(coefs[length:], -5)
+        frames = pywt.idwt(approx, details, "sym7", "periodization")
+        length *= 2
+        for i in range(1, layout["compressionLevel"]):
+            frames = pywt.idwt(frames[:length], None, "sym7", "periodization")
+            length *= 2
+        data.extend(frames[2:-2])
+        position += layout["coefsBlockLength"]
+    return np.array(data)
+
+
+def write_recording(folder, name, nChannels=256):
+    # the recording and an _exportCh selection of 16 of its channels
+    write, Ver, Typ = FORMATS[name]
+    recfileName = os.path.join(folder, f"check_{name}.brw")
+    chfileName = os.path.join(folder, f"check_{name}_exportCh.brw")
+    samplingRate = 17855.5 if Ver == "BW4" else 20000.0
+    if Ver == "BW4":
+        write(recfileName, CHECK_FRAMES, samplingRate, nChannels=nChannels)
+    else:
+        write(recfileName, CHECK_FRAMES, samplingRate)
+    write_exportCh(
+        chfileName,
+        getChMap()[:nChannels:16],
+        Ver.encode(),
+        Typ.encode(),
+        CHECK_FRAMES,
+        samplingRate,
+        CHECK_RATES,
+        CHECK_START,
+        CHECK_END,
+    )
+    return chfileName, recfileName
+
+
+def check_WAV_decode(folder):
+    for name in ("BW4-WAV", "BW5-WAV"):
+        chfileName, recfileName = write_recording(folder, name)
+        with h5py.File(recfileName, "r") as h5:
+            layout = export_to_brw.get_WAV_layout(h5)
+            channels = np.array([0, 5, layout["nChannels"] - 1])
+            ref = np.array(
+                [
+                    per_chunk_decode(h5, layout["dataset"], channel, layout)
+                    for channel in channels
+                ]
+            )
+            blocks = export_to_brw.decode_WAV_blocks(
+                h5, channels, layout, 0, layout["numChunks"]
+            )
+            channel = export_to_brw.decode_WAV_channel(
+                h5, channels[1], layout, 0, layout["numChunks"]
+            )
+        # the bulk decoders run in float32, the samples are whole ADC counts
+        assert blocks.shape == ref.shape, (name, blocks.shape, ref.shape)
+        assert np.abs(blocks - ref).max() < 1e-2, name
+        assert np.array_equal(channel, blocks[1]), name
+        print(f"WAV decode {name}: max error {np.abs(blocks - ref).max():.1e}")
+
+
+def source_frames(chfileName, recfileName):
+    # full-rate frames of the exported channels and time range, read without the
+    # exporter, in the channel order of the outputs
+    chfileInfo = export_to_brw.get_chfile_properties(chfileName)
+    parameters = export_to_brw.get_recFile_properties(
+        recfileName, chfileInfo["Ver"].lower()
+    )
+    chs, ind_rec, ind_ch = np.intersect1d(
+        parameters["recElectrodeList"],
+        chfileInfo["recElectrodeList"],
+        return_indices=True,
+    )
+    ind_rec = ind_rec[np.lexsort((chs["Col"], chs["Row"]))]
+    start_frame, end_frame = export_to_brw.time_window(
+        recfileName, chfileInfo, parameters
+    )
+    with h5py.File(recfileName, "r") as h5:
+        if chfileInfo["Typ"] == b"WAV":
+            layout = export_to_brw.get_WAV_layout(h5)
+            frames = np.array(
+                [
+                    per_chunk_decode(h5, layout["dataset"], channel, layout)
+                    for channel in ind_rec
+                ]
+            )
+        else:
+            dataset = "/3BData/Raw" if chfileInfo["Ver"] == b"BW4" else "Well_A1/Raw"
+            frames = h5[dataset][:].reshape(-1, parameters["numRecElectrodes"])
+            frames = frames[:, ind_rec].T
+    return frames[:, start_frame:end_frame].astype(np.float64)
+
+
+def export(chfileName, recfileName, options):
+    chfileInfo = export_to_brw.get_chfile_properties(chfileName)
+    parameters = export_to_brw.get_recFile_properties(
+        recfileName, chfileInfo["Ver"].lower()
+    )
+    extract = export_to_brw.get_extractor(chfileInfo)
+    totTime, output_paths = extract(
+        chfileName, recfileName, chfileInfo, parameters, options
+    )
+    return output_paths
+
+
+def read_outputs(output_paths, remove=True):
+    # every dataset of each output, by rate, the files are removed afterwards
+    outputs = {}
+    for path in output_paths:
+        datasets = {}
+        with h5py.File(path, "r") as h5:
+            assert h5.attrs["ExportComplete"], path
+            assert "/ExportCheckpoint" not in h5, path
+            h5.visititems(
+                lambda key, value: datasets.update(
+                    {key: value[()]} if isinstance(value, h5py.Dataset) else {}
+                )
+            )
+        outputs[path.split("_resample_")[-1]] = datasets
+        if remove:
+            os.remove(path)
+    return outputs
+
+
+def assert_same_outputs(outputs, expected, what):
+    assert outputs.keys() == expected.keys(), what
+    for rate, datasets in expected.items():
+        assert outputs[rate].keys() == datasets.keys(), (what, rate)
+        for key, value in datasets.items():
+            assert np.array_equal(outputs[rate][key], value), (what, rate, key)
+
+
+@contextlib.contextmanager
+def patched(owner, name, replacement):
+    # swaps owner.<name> for replacement(original) while the block runs
+    original = getattr(owner, name)
+    setattr(owner, name, replacement(original))
+    try:
+        yield
+    finally:
+        setattr(owner, name, original)
+
+
+def crashed_export(chfileName, recfileName, options, *patches):
+    with contextlib.ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patched(*patch))
+        try:
+            export(chfileName, recfileName, options)
+        except SimulatedCrash:
+            pass
+        else:
+            raise AssertionError("the simulated crash did not happen")
+    # the crashed writers still hold their output files open
+    gc.collect()
+
+
+def crash_at_window(crashWindow):
+    def replacement(write_window):
+        def crashing(outputs, window, *args):
+            if window == crashWindow:
+                raise SimulatedCrash(f"window {window}")
+            write_window(outputs, window, *args)
+
+        return crashing
+
+    return (export_to_brw, "write_window", replacement)
+
+
+def crash_before_close():
+    def replacement(close_outputs):
+        def crashing(*args):
+            raise SimulatedCrash("close")
+
+        return crashing
+
+    return (export_to_brw, "close_outputs", replacement)
+
+
+def checkpoints_until(rate, lastWindow):
+    # the output at rate stops taking checkpoints after lastWindow, so the outputs
+    # of one job are resumed from different windows
+    def replacement(checkpoint):
+        def limited(self, window, *args, **kwargs):
+            if window <= lastWindow or not self.fileName.endswith(f"_{rate}.brw"):
+                checkpoint(self, window, *args, **kwargs)
+
+        return limited
+
+    return (export_to_brw.writeBrw, "checkpoint", replacement)
+
+
+def check_exports(folder, formats=tuple(FORMATS), workers=3):
+    options = {
+        "window_frames": CHECK_WINDOW_FRAMES,
+        "workers": workers,
+        "checkpoint_seconds": 0,
+    }
+    for name in formats:
+        chfileName, recfileName = write_recording(folder, name)
+        windowed = read_outputs(export(chfileName, recfileName, options))
+
+        # the same export in a single window, and resample_poly over the whole range
+        single = read_outputs(
+            export(chfileName, recfileName, dict(options, window_frames=10**6))
+        )
+        for rate, datasets in windowed.items():
+            for key, value in datasets.items():
+                if key.startswith("3BData/Stats"):
+                    # the float64 sums are accumulated in different slices
+                    assert np.allclose(value, single[rate][key], rtol=1e-9), key
+                else:
+                    assert np.array_equal(value, single[rate][key]), (name, key)
+        frames = source_frames(chfileName, recfileName)
+        samplingRate = export_to_brw.get_chfile_properties(chfileName)["recSampling"]
+        for newSampling in CHECK_RATES:
+            resampler = StreamResampler(samplingRate, newSampling, 1)
+            ref = scipy.signal.resample_poly(
+                frames, resampler.up, resampler.down, axis=1
+            )
+            raw = windowed[f"{int(newSampling)}.brw"]["3BData/Raw"]
+            raw = raw.reshape(-1, len(frames)).T
+            assert raw.shape == ref.shape, (name, newSampling, raw.shape, ref.shape)
+            # the exporter filters in float32 before rounding to counts
+            assert np.abs(raw - np.rint(ref)).max() <= 1, (name, newSampling)
+        print(f"{name}: windowed export matches the single pass")
+
+        # interrupted exports picked up from their checkpoints
+        for description, patches in (
+            ("crash in window 3", [crash_at_window(3)]),
+            ("crash before closing", [crash_before_close()]),
+            (
+                "outputs checkpointed at different windows",
+                [checkpoints_until(300, 2), crash_at_window(5)],
+            ),
+        ):
+            crashed_export(chfileName, recfileName, options, *patches)
+            resumed = read_outputs(export(chfileName, recfileName, options))
+            assert_same_outputs(resumed, windowed, f"{name}, {description}")
+            print(f"{name}: resumed after {description}, bit-identical")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the resampler, the WAV decoder, the windowed export and "
+        "resuming against reference results on synthetic recordings"
+    )
+    parser.add_argument(
+        "--formats", nargs="+", choices=list(FORMATS), default=list(FORMATS)
+    )
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument(
+        "--dir",
+        default=None,
+        help="folder to write the test files to, created if it does not exist",
+    )
+    args = parser.parse_args()
+
+    if args.dir is not None:
+        os.makedirs(args.dir, exist_ok=True)
+    check_resampler()
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        check_WAV_decode(tmp)
+        check_exports(tmp, args.formats, args.workers)
+    print("all checks passed")
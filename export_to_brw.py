@@ -1,5 +1,10 @@
 import math
-from multiprocessing import Pool
+from multiprocessing import Pool, resource_tracker, shared_memory
+import pickle
+import contextlib
+import functools
+import traceback
+from fractions import Fraction
 import sys
 from alert import alert
 
@@ -21,22 +26,66 @@ import scipy
 import scipy.signal
 
 from tqdm import tqdm
-import clr  # pip install pythonnet
 
-# For the code to run, BrianWave5 software needs to be installed, the path for the *.dll files should be changed below accordingly
-clr.AddReference(
-    os.path.join("C:\\Program Files\\3Brain\\BrainWave 5", "3Brain.BrainWave.IO.dll")
+from metadata_index import cached_properties, wav_frame_count
+
+# Default export settings, single entries can be overridden per job through the
+# options argument of the extractors
+EXPORT_OPTIONS = {
+    # full-rate frames decoded and written per window, bounds the peak memory
+    "window_frames": 100000,
+    # storage of /3BData/Raw in the output file: output frames per HDF5 chunk
+    # (None lets h5py decide), "gzip"/"lzf"/None, gzip level and byte shuffle
+    "chunk_frames": None,
+    "compression": None,
+    "compression_opts": 4,
+    "shuffle": False,
+    # "frames" stores /3BData/Raw as the frame-interleaved 1-D stream, "channels"
+    # as a (channels, frames) array chunked along time so one channel is one
+    # contiguous read. The dataset's Layout attribute tells readers which it is.
+    "raw_layout": "frames",
+    # "counts" writes rounded, clipped int16 ADC counts, "uV" float32 microvolts
+    "output_units": "counts",
+    # size of the worker pool, None uses every core
+    "workers": None,
+    # read contiguous, unfiltered Raw streams through a memory map instead of h5py
+    "raw_memmap": True,
+    # least time between two resume checkpoints written to a partial output
+    "checkpoint_seconds": 60,
+    # full-rate per-channel statistics stored in /3BData/Stats, as the
+    # [low, high] Hz bands whose power is measured, None skips them
+    "stats_bands": [[1, 4], [4, 8], [8, 13], [13, 30], [30, 80], [80, 250]],
+    # samples per bin between the levels of the min/max envelope stored in
+    # /3BData/Envelope, None leaves it out
+    "envelope_factor": 16,
+    # per-stage timing report of a run() batch, written into the folder, and
+    # whether its summary table is printed at the end
+    "report": "export_report.json",
+    "report_table": True,
+}
+
+
+# output frames per chunk of a channel-major Raw when chunk_frames is not set
+CHANNEL_CHUNK_FRAMES = 16384
+
+# upper bound on the resampling ratio denominator, keeps the polyphase filter small
+MAX_RESAMPLE_DENOMINATOR = 100000
+
+# input values StreamResampler gathers into the windows of its outputs at a time
+RESAMPLE_VALUES = 2**22
+
+# BrainWave's .NET reader, only used for BW4 wavelet files the h5py reader does not
+# understand. The path has to match the local BrainWave 5 installation.
+BRAINWAVE_IO_DLL = os.path.join(
+    "C:\\Program Files\\3Brain\\BrainWave 5", "3Brain.BrainWave.IO.dll"
 )
 
-from System import Int32, Double, Boolean
-from _3Brain.BrainWave.IO import BrwFile
-from _3Brain.BrainWave.Common import (
-    MeaFileExperimentInfo,
-    RawDataSettings,
-    ExperimentType,
-    MeaPlate,
-)
-from _3Brain.Common import MeaPlateModel, MeaChipRoi, MeaDataType, ChCoord
+
+def get_export_options(options=None):
+    merged = dict(EXPORT_OPTIONS)
+    if options:
+        merged.update(options)
+    return merged
 
 
 def getChMap():
@@ -51,14 +100,15 @@ def getChMap():
             column = 1
 
         newChs[idx] = (np.int16(row), np.int16(column))
-        ind = np.lexsort((newChs["Col"], newChs["Row"]))
+    ind = np.lexsort((newChs["Col"], newChs["Row"]))
     return newChs[ind]
 
 
 class writeBrw:
-    def __init__(self, inputFilePath, outputFile, parameters):
+    def __init__(self, inputFilePath, outputFile, parameters, options=None):
         self.path = inputFilePath
         self.fileName = outputFile
+        self.options = get_export_options(options)
         # self.brw = h5py.File(self.path, 'r')
         self.description = parameters["Ver"]
         self.version = parameters["Typ"]
@@ -71,6 +121,13 @@ class writeBrw:
         self.chs = parameters["recElectrodeList"]
         self.QLevel = np.power(2, parameters["bitDepth"])
         self.fromQLevelToUVolt = (self.maxVolt - self.minVolt) / self.QLevel
+        if self.options["output_units"] == "uV":
+            self.ADCCountsToMV, self.MVOffset = Digital_to_Analog(parameters)
+            self.rawType = np.float32
+        else:
+            self.rawType = np.int16
+        self.envelope = None
+        self.pendingRaw = []
 
         # self.signalInversion = self.brw['3BRecInfo/3BRecVars/SignalInversion']
         # self.maxVolt = self.brw['3BRecInfo/3BRecVars/MaxVolt'][0]
@@ -126,22 +183,129 @@ class writeBrw:
         self.newDataset = new
         # self.brw.close()
 
+    def channelMajor(self):
+        return self.options["raw_layout"] == "channels"
+
+    def chunkFrames(self):
+        return int(self.options["chunk_frames"] or CHANNEL_CHUNK_FRAMES)
+
+    def rawStorage(self, nChannels, nFrames=0):
+        # chunk shape and filters of /3BData/Raw, h5py picks the chunks of a
+        # frame-interleaved stream when unset
+        storage = {}
+        if self.channelMajor():
+            # a short output does not need chunks longer than itself, 0 frames means
+            # the length is not known yet
+            storage["chunks"] = (1, min(self.chunkFrames(), int(nFrames) or np.inf))
+        elif self.options["chunk_frames"]:
+            storage["chunks"] = (int(self.options["chunk_frames"]) * int(nChannels),)
+        if self.options["compression"]:
+            storage["compression"] = self.options["compression"]
+            if self.options["compression"] == "gzip":
+                storage["compression_opts"] = self.options["compression_opts"]
+        if self.options["shuffle"]:
+            storage["shuffle"] = True
+        return storage
+
+    def allocateRaw(self, nChannels, nFrames):
+        # the full output is reserved up front, blocks are then written in place
+        self.createRaw(nChannels, nFrames)
+        self.rawWritten = 0
+        self.startEnvelope(nChannels, nFrames)
+
+    def createRaw(self, nChannels, nFrames):
+        if self.channelMajor():
+            shape = (int(nChannels), int(nFrames))
+            maxshape = (int(nChannels), None)
+        else:
+            shape = (int(nChannels) * int(nFrames),)
+            maxshape = (None,)
+        self.newDataset.create_dataset(
+            "/3BData/Raw",
+            shape=shape,
+            dtype=self.rawType,
+            maxshape=maxshape,
+            **self.rawStorage(nChannels, nFrames),
+        )
+        self.newDataset["3BData/Raw"].attrs["Units"] = self.options["output_units"]
+        self.newDataset["3BData/Raw"].attrs["Layout"] = self.options["raw_layout"]
+
+    def startEnvelope(self, nChannels, nFrames=0):
+        if self.options["envelope_factor"]:
+            self.envelope = EnvelopePyramid(
+                nChannels, self.options["envelope_factor"], self.rawType, nFrames
+            )
+
+    def toRawType(self, raw):
+        # samples stay float32 up to here, the single conversion happens on write
+        if self.rawType == np.float32:
+            return np.float32(raw * self.ADCCountsToMV + self.MVOffset)
+        if raw.dtype == np.int16:
+            return raw
+        return np.int16(np.clip(np.rint(raw), -32768, 32767))
+
     def writeRaw(self, rawToWrite, typeFlatten="F"):
         # rawToWrite = rawToWrite / self.fromQLevelToUVolt
         # rawToWrite = (rawToWrite + (self.QLevel / 2)) * self.signalInversion
 
         if rawToWrite.ndim == 1:
-            newRaw = rawToWrite
+            newRaw = self.toRawType(rawToWrite)
         else:
-            newRaw = np.int16(rawToWrite.flatten(typeFlatten))
-
-        if "/3BData/Raw" in self.newDataset:
-            dset = self.newDataset["3BData/Raw"]
-            dset.resize((dset.shape[0] + newRaw.shape[0],))
-            dset[-newRaw.shape[0] :] = newRaw
-
-        else:
-            self.newDataset.create_dataset("/3BData/Raw", data=newRaw, maxshape=(None,))
+            newRaw = self.toRawType(rawToWrite)
+            if self.envelope is not None:
+                self.envelope.add(newRaw)
+                self.envelope.write(self.newDataset)
+            if self.channelMajor():
+                self.writeChannels(newRaw)
+                return
+            newRaw = newRaw.flatten(typeFlatten)
+
+        if "/3BData/Raw" not in self.newDataset:
+            self.newDataset.create_dataset(
+                "/3BData/Raw",
+                data=newRaw,
+                maxshape=(None,),
+                **self.rawStorage(1 if rawToWrite.ndim == 1 else rawToWrite.shape[0]),
+            )
+            self.newDataset["3BData/Raw"].attrs["Units"] = self.options["output_units"]
+            self.newDataset["3BData/Raw"].attrs["Layout"] = "frames"
+            self.rawWritten = newRaw.shape[0]
+            return
+
+        dset = self.newDataset["3BData/Raw"]
+        end = self.rawWritten + newRaw.shape[0]
+        if end > dset.shape[0]:
+            dset.resize((end,))
+        dset[self.rawWritten : end] = newRaw
+        self.rawWritten = end
+
+    def writeChannels(self, newRaw, force=False):
+        # channel-major blocks are held back until whole chunks can be written, a
+        # partial chunk would otherwise be read back and rewritten for every block
+        if newRaw is not None:
+            self.pendingRaw.append(newRaw)
+        if not self.pendingRaw:
+            return
+        nChannels = self.pendingRaw[0].shape[0]
+        if "/3BData/Raw" not in self.newDataset:
+            self.createRaw(nChannels, 0)
+            self.rawWritten = 0
+        dset = self.newDataset["3BData/Raw"]
+
+        first = self.rawWritten // nChannels
+        end = first + sum(block.shape[1] for block in self.pendingRaw)
+        if not force:
+            end -= end % dset.chunks[1]
+        if end <= first:
+            return
+        pending = np.concatenate(self.pendingRaw, axis=1)
+        if end > dset.shape[1]:
+            dset.resize((nChannels, end))
+        dset[:, first:end] = pending[:, : end - first]
+        self.pendingRaw = (
+            [pending[:, end - first :]] if end - first < pending.shape[1] else []
+        )
+        self.rawWritten = end * nChannels
 
     def writeChs(self, chs):
         self.newDataset.create_dataset("/3BRecInfo/3BMeaStreams/Raw/Chs", data=chs)
@@ -156,31 +320,120 @@ class writeBrw:
             "/3BRecInfo/3BRecVars/SamplingRate", data=[np.float64(fs)]
         )
 
-    def appendBrw(self, fName, frames, rawToAppend, typeFlatten="F"):
-        brwAppend = h5py.File(fName, "a")
-
-        signalInversion = brwAppend["3BRecInfo/3BRecVars/SignalInversion"]
-        maxVolt = brwAppend["3BRecInfo/3BRecVars/MaxVolt"][0]
-        minVolt = brwAppend["3BRecInfo/3BRecVars/MinVolt"][0]
-        QLevel = np.power(2, brwAppend["3BRecInfo/3BRecVars/BitDepth"][0])
-        fromQLevelToUVolt = (maxVolt - minVolt) / QLevel
-
-        newFrame = frames
-        del brwAppend["/3BRecInfo/3BRecVars/NRecFrames"]
-        brwAppend.create_dataset(
-            "/3BRecInfo/3BRecVars/NRecFrames", data=[np.int64(newFrame)]
-        )
-
-        if rawToAppend.ndim != 1:
-            rawToAppend = np.int16(rawToAppend.flatten(typeFlatten))
-
-        dset = brwAppend["3BData/Raw"]
-        dset.resize((dset.shape[0] + rawToAppend.shape[0],))
-        dset[-rawToAppend.shape[0] :] = rawToAppend
-
-        brwAppend.close()
+    def startJob(self, job, nChannels, nFrames):
+        # returns "complete" when a finished output of the same job is already there,
+        # the last checkpoint when a partial one can be resumed, None otherwise
+        self.job = json.dumps(job, sort_keys=True)
+        self.lastCheckpoint = time.time()
+        new = None
+        if os.path.exists(self.fileName):
+            try:
+                new = h5py.File(self.fileName, "a")
+            except OSError:
+                # a file left unreadable by the crash is simply redone
+                pass
+
+        if new is not None:
+            if new.attrs.get("ExportJob") != self.job:
+                new.close()
+            elif new.attrs.get("ExportComplete"):
+                new.close()
+                return "complete"
+            elif (
+                "/ExportCheckpoint" in new
+                and new["/ExportCheckpoint"].attrs["window_frames"]
+                == self.options["window_frames"]
+            ):
+                self.newDataset = new
+                checkpoint = dict(new["/ExportCheckpoint"].attrs)
+                checkpoint["buffer"] = new["/ExportCheckpoint/buffer"][:]
+                for name in ("stats", "envelope"):
+                    if "/ExportCheckpoint/" + name in new:
+                        checkpoint[name] = {
+                            key: value[()]
+                            for key, value in new["/ExportCheckpoint/" + name].items()
+                        }
+                self.rawWritten = int(checkpoint["rawWritten"])
+                self.startEnvelope(nChannels, nFrames)
+                if self.envelope is not None:
+                    self.envelope.restore(checkpoint["envelope"])
+                # metadata of an interrupted close is written again at the end
+                for name in ("NRecFrames", "SamplingRate"):
+                    if "/3BRecInfo/3BRecVars/" + name in new:
+                        del new["/3BRecInfo/3BRecVars/" + name]
+                for name in ("/3BRecInfo/3BMeaStreams/Raw/Chs", "/3BData/Stats"):
+                    if name in new:
+                        del new[name]
+                return checkpoint
+            else:
+                new.close()
+
+        self.createNewBrw()
+        self.allocateRaw(nChannels, nFrames)
+        self.newDataset.attrs["ExportJob"] = self.job
+        self.newDataset.attrs["ExportComplete"] = False
+        return None
+
+    def writeStats(self, stats, ind):
+        # statistics of the full-rate samples, in the units and Chs order of Raw
+        if self.rawType == np.float32:
+            values = stats.finish(self.ADCCountsToMV, self.MVOffset)
+        else:
+            values = stats.finish()
+        group = self.newDataset.create_group("/3BData/Stats")
+        for name, value in values.items():
+            group.create_dataset(name, data=value[ind])
+        group.attrs["Bands"] = stats.bands
+        group.attrs["SamplingRate"] = stats.samplingRate
+        group.attrs["NFrames"] = stats.nFrames
+        group.attrs["Units"] = self.options["output_units"]
+
+    def checkpoint(self, window, resampler, stats=None, force=False):
+        # records that every window before `window` is on disk, at most once per
+        # checkpoint_seconds so the flushes stay cheap
+        if (
+            not force
+            and time.time() - self.lastCheckpoint < self.options["checkpoint_seconds"]
+        ):
+            return
+        if self.envelope is not None:
+            self.envelope.write(self.newDataset, force=True)
+        self.writeChannels(None, force=True)
+        self.newDataset.flush()
+        if "/ExportCheckpoint" in self.newDataset:
+            del self.newDataset["/ExportCheckpoint"]
+        group = self.newDataset.create_group("/ExportCheckpoint")
+        state = resampler.state()
+        group.create_dataset("buffer", data=state.pop("buffer"))
+        for key, value in state.items():
+            group.attrs[key] = value
+        if stats is not None:
+            for key, value in stats.state().items():
+                group.create_dataset("stats/" + key, data=value)
+        if self.envelope is not None:
+            for key, value in self.envelope.state().items():
+                group.create_dataset("envelope/" + key, data=value)
+        group.attrs["window"] = window
+        group.attrs["rawWritten"] = self.rawWritten
+        group.attrs["window_frames"] = self.options["window_frames"]
+        self.newDataset.flush()
+        self.lastCheckpoint = time.time()
 
     def close(self):
+        if self.envelope is not None:
+            self.envelope.finish(self.newDataset)
+        self.writeChannels(None, force=True)
+        # drop whatever part of the reservation was not filled
+        if "/3BData/Raw" in self.newDataset:
+            dset = self.newDataset["3BData/Raw"]
+            if dset.ndim == 2:
+                dset.resize((dset.shape[0], self.rawWritten // dset.shape[0]))
+            elif self.rawWritten < dset.shape[0]:
+                dset.resize((self.rawWritten,))
+        if "/ExportCheckpoint" in self.newDataset:
+            del self.newDataset["/ExportCheckpoint"]
+        if "ExportJob" in self.newDataset.attrs:
+            self.newDataset.attrs["ExportComplete"] = True
         self.newDataset.close()
         # self.brw.close()
 
@@ -201,7 +454,7 @@ def parameter(h5):
         0
     ]  # number of used bit of the 2 byte coding
     parameters["qLevel"] = (
-        2 ^ parameters["bitDepth"]
+        2 ** parameters["bitDepth"]
     )  # quantized levels corresponds to 2^num of bit to encode the signal
     parameters["fromQLevelToUVolt"] = (
         parameters["maxUVolt"] - parameters["minUVolt"]
@@ -219,19 +472,544 @@ def Digital_to_Analog(parameters):
     return ADCCountsToMV, MVOffset
 
 
-def downsample_channel(data, freq_ratio):
-    # s = time.time()
-    re_sampleRatio = int(data.shape[0] / freq_ratio)
-    data_downsampled = scipy.signal.resample(data, re_sampleRatio)
-    return data_downsampled
+@functools.lru_cache(maxsize=8)
+def polyphase_filter(up, down):
+    # anti-aliasing filter of an up / down resampler split into its up phases, and
+    # the leading outputs to drop, cached because every worker rebuilds the
+    # resamplers of a job for each block
+    if up == down:
+        return np.ones((1, 1), dtype=np.float32), 0
+    # same filter as resample_poly, pre-padded so that its group delay is a whole
+    # number of output samples
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = scipy.signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+    pre_pad = down - half_len % down
+    h = np.concatenate([np.zeros(pre_pad), h * up])
+    # phase p holds the taps h[p], h[p + up], ... reversed, so that they line up
+    # with the input frames in recording order
+    h = np.pad(h, (0, -len(h) % up))
+    return (
+        np.ascontiguousarray(np.float32(h.reshape(-1, up).T[:, ::-1])),
+        (half_len + pre_pad) // down,
+    )
+
+
+class StreamResampler:
+    """Polyphase FIR resampler that carries its filter state across blocks.
+
+    Blocks are (channels, frames) arrays fed in recording order through process(),
+    flush() returns the tail once the last block has been seen. The concatenated
+    output matches scipy.signal.resample_poly run over the whole recording, up to
+    the float32 precision the filter runs in.
+    """
+
+    def __init__(self, samplingRate, newSampling, nChannels):
+        # exact rational ratio between the two rates, e.g. 300 / 17855.5 = 600 / 35711
+        ratio = (
+            Fraction(str(newSampling)) / Fraction(str(samplingRate))
+        ).limit_denominator(MAX_RESAMPLE_DENOMINATOR)
+        self.rates = (samplingRate, newSampling)
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        self.newSampling = float(samplingRate) * self.up / self.down
+        self.nChannels = nChannels
+        self.phases, self.skip = polyphase_filter(self.up, self.down)
+
+        self.nIn = 0
+        self.nextOut = self.skip
+        # input frame of buffer[:, 0], the first outputs reach back before the
+        # recording and the buffer starts with those frames as zeros
+        first = self.skip * self.down // self.up - self.phases.shape[1] + 1
+        self.bufferStart = min(0, first)
+        self.buffer = np.zeros((nChannels, -self.bufferStart), dtype=np.float32)
+
+    def state(self):
+        return {
+            "buffer": self.buffer,
+            "bufferStart": self.bufferStart,
+            "nIn": self.nIn,
+            "nextOut": self.nextOut,
+        }
+
+    def restore(self, state):
+        # picks up a stream saved by state(), e.g. from a resume checkpoint
+        self.buffer = np.asarray(state["buffer"], dtype=np.float32)
+        self.bufferStart = int(state["bufferStart"])
+        self.nIn = int(state["nIn"])
+        self.nextOut = int(state["nextOut"])
+
+    def output_length(self, nFrames):
+        return -(-nFrames * self.up // self.down)
+
+    def history(self):
+        # most input frames the buffer keeps between two blocks, the frames an
+        # output reaches back to plus a block too short to complete an output
+        return self.phases.shape[1] + -(-self.down // self.up)
+
+    def process(self, block):
+        self.buffer = np.concatenate(
+            [self.buffer, block.astype(np.float32, copy=False)], axis=1
+        )
+        self.nIn += block.shape[1]
+        # last output whose inputs have all arrived
+        return self._emit((self.nIn * self.up - 1) // self.down)
+
+    def flush(self):
+        return self._emit(self.skip + self.output_length(self.nIn) - 1)
+
+    def _emit(self, last):
+        if last < self.nextOut:
+            return np.zeros((self.nChannels, 0), dtype=np.float32)
+
+        # output n is the dot product of filter phase n * down % up with the input
+        # frames up to n * down // up, evaluated for the new outputs only
+        taps = self.phases.shape[1]
+        outputs = np.arange(self.nextOut, last + 1)
+        newest = outputs * self.down // self.up
+        phase = outputs * self.down - newest * self.up
+        # the frames after the end of the recording are zeros, as are those before
+        # a buffer restored from a checkpoint that kept fewer frames
+        before = max(0, taps - 1 - newest[0] + self.bufferStart)
+        after = max(0, newest[-1] + 1 - self.bufferStart - self.buffer.shape[1])
+        frames = self.buffer
+        if before or after:
+            frames = np.pad(frames, ((0, 0), (before, after)))
+        windows = np.lib.stride_tricks.sliding_window_view(frames, taps, axis=1)
+        oldest = newest - taps + 1 - self.bufferStart + before
+        out = np.empty((self.nChannels, len(outputs)), dtype=np.float32)
+        step = max(1, RESAMPLE_VALUES // (self.nChannels * taps))
+        for i in range(0, len(outputs), step):
+            out[:, i : i + step] = np.einsum(
+                "cnt,nt->cn",
+                windows[:, oldest[i : i + step]],
+                self.phases[phase[i : i + step]],
+            )
+        self.nextOut = last + 1
+
+        # drop the input frames no later output reaches back to
+        start = max(self.bufferStart, self.nextOut * self.down // self.up - taps + 1)
+        self.buffer = self.buffer[:, start - self.bufferStart :]
+        self.bufferStart = start
+        return out
+
+
+# full-rate frames ChannelStats converts to float64 at a time
+STATS_FRAMES = 4096
+
+# ChannelStats accumulators with one entry per channel along their first axis
+STATS_CHANNEL_KEYS = (
+    "sum",
+    "sumSquares",
+    "min",
+    "max",
+    "lineLength",
+    "last",
+    "bandEnergy",
+)
+
+
+class ChannelStats:
+    """Per-channel summary statistics accumulated over full-rate blocks.
+
+    Blocks are (channels, frames) arrays fed in recording order through update().
+    The line length carries the last sample of each block and the band filters
+    carry their state, so the results do not depend on how the stream was split.
+    """
+
+    def __init__(self, samplingRate, nChannels, bands):
+        self.samplingRate = float(samplingRate)
+        # bands reaching past Nyquist cannot be measured and are left out
+        self.bands = np.array(
+            [band for band in bands if 0 < band[0] < band[1] < samplingRate / 2],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        self.sos = [
+            scipy.signal.butter(
+                2, band, btype="bandpass", fs=self.samplingRate, output="sos"
+            )
+            for band in self.bands
+        ]
+        self.nFrames = 0
+        self.sum = np.zeros(nChannels)
+        self.sumSquares = np.zeros(nChannels)
+        self.min = np.full(nChannels, np.inf)
+        self.max = np.full(nChannels, -np.inf)
+        self.lineLength = np.zeros(nChannels)
+        self.last = np.full(nChannels, np.nan)
+        self.bandEnergy = np.zeros((nChannels, len(self.bands)))
+        self.zi = np.zeros(
+            (len(self.bands), len(self.sos[0]) if self.sos else 0, nChannels, 2)
+        )
+
+    def state(self):
+        return {
+            "nFrames": self.nFrames,
+            "sum": self.sum,
+            "sumSquares": self.sumSquares,
+            "min": self.min,
+            "max": self.max,
+            "lineLength": self.lineLength,
+            "last": self.last,
+            "bandEnergy": self.bandEnergy,
+            "zi": self.zi,
+        }
+
+    def restore(self, state):
+        # picks up the accumulators saved by state(), e.g. from a resume checkpoint
+        self.nFrames = int(state["nFrames"])
+        for key in ("sum", "sumSquares", "min", "max", "lineLength", "last"):
+            setattr(self, key, np.asarray(state[key], dtype=np.float64))
+        self.bandEnergy = np.asarray(state["bandEnergy"], dtype=np.float64)
+        self.zi = np.asarray(state["zi"], dtype=np.float64)
+
+    def groupState(self, first, last):
+        # state() of the channels [first, last), for a worker to update
+        state = {key: getattr(self, key)[first:last] for key in STATS_CHANNEL_KEYS}
+        state["nFrames"] = self.nFrames
+        state["zi"] = self.zi[:, :, first:last]
+        return state
+
+    def restoreGroup(self, first, last, state):
+        # takes back the channels [first, last) a worker has updated
+        for key in STATS_CHANNEL_KEYS:
+            getattr(self, key)[first:last] = state[key]
+        self.zi[:, :, first:last] = state["zi"]
+        self.nFrames = int(state["nFrames"])
+
+    def update(self, block):
+        # float64 copies of a whole window would double its memory, slices are
+        # accumulated one after the other instead
+        for start in range(0, block.shape[1], STATS_FRAMES):
+            self._update(block[:, start : start + STATS_FRAMES].astype(np.float64))
+
+    def _update(self, block):
+        if self.nFrames == 0:
+            # the band filters start settled on the first sample, a BW4 baseline
+            # would otherwise ring through the first seconds of band power
+            for i, sos in enumerate(self.sos):
+                self.zi[i] = (
+                    scipy.signal.sosfilt_zi(sos)[:, None, :] * block[None, :, :1]
+                )
+        self.nFrames += block.shape[1]
+        self.sum += block.sum(axis=1)
+        self.sumSquares += np.einsum("ij,ij->i", block, block)
+        np.minimum(self.min, block.min(axis=1), out=self.min)
+        np.maximum(self.max, block.max(axis=1), out=self.max)
+
+        # the first step of the recording has no previous sample, nansum drops it
+        self.lineLength += np.nansum(np.abs(block[:, :1] - self.last[:, None]), axis=1)
+        self.lineLength += np.abs(np.diff(block, axis=1)).sum(axis=1)
+        self.last = block[:, -1].copy()
+
+        for i, sos in enumerate(self.sos):
+            filtered, self.zi[i] = scipy.signal.sosfilt(
+                sos, block, axis=1, zi=self.zi[i]
+            )
+            self.bandEnergy[:, i] += np.einsum("ij,ij->i", filtered, filtered)
+
+    def finish(self, scale=1.0, offset=0.0):
+        # results for values written as scale * sample + offset
+        n = max(self.nFrames, 1)
+        mean = self.sum / n
+        meanSquare = self.sumSquares / n
+        low, high = scale * self.min + offset, scale * self.max + offset
+        return {
+            "Mean": scale * mean + offset,
+            "RMS": np.sqrt(
+                np.maximum(
+                    scale**2 * meanSquare + 2 * scale * offset * mean + offset**2, 0
+                )
+            ),
+            "Min": np.minimum(low, high),
+            "Max": np.maximum(low, high),
+            "LineLength": abs(scale) * self.lineLength,
+            "BandPower": scale**2 * self.bandEnergy / n,
+        }
+
+
+# envelope bins per channel in one HDF5 chunk, and the most held back before a write
+ENVELOPE_CHUNK = 1024
+
+
+class EnvelopePyramid:
+    """Min/max envelope of the written samples at factor, factor^2, ... per bin.
+
+    Blocks are (channels, frames) arrays in the order they are written to Raw.
+    Level k reduces the bins of level k - 1, so the pyramid grows with the output
+    and never needs a second pass. Each level is stored as /3BData/Envelope/<k>/Min
+    and Max of shape (channels, bins), in chunks of at most ENVELOPE_CHUNK values,
+    so drawing one channel at any zoom reads only a few kB. The last bin of a
+    level may cover fewer samples; the top level is a single bin holding the
+    global min and max. nFrames, the expected output length, sizes the chunks to
+    the levels so short levels are not allocated far larger than their bins.
+    """
+
+    def __init__(self, nChannels, factor, dtype, nFrames=0):
+        self.nChannels = nChannels
+        self.factor = int(factor)
+        self.dtype = dtype
+        self.nFrames = int(nFrames)
+        # per level: samples not yet reduced into a bin, bins not yet on disk and
+        # bins already on disk
+        self.pending = []
+        self.unwritten = []
+        self.written = []
+
+    def _empty(self):
+        return np.zeros((self.nChannels, 0), dtype=self.dtype)
+
+    def _chunks(self, level):
+        # uncompressed chunks take their full size on disk, so the expected bins of
+        # a level are split into equal chunks of at most ENVELOPE_CHUNK. Chunks of
+        # a short level span several channels instead. 0 frames means the length
+        # is not known.
+        bins = -(-self.nFrames // self.factor ** (level + 1)) or ENVELOPE_CHUNK
+        bins = -(-bins // -(-bins // ENVELOPE_CHUNK))
+        return (min(self.nChannels, ENVELOPE_CHUNK // bins), bins)
+
+    def _bins(self, level):
+        return self.written[level] + sum(
+            lo.shape[1] for lo, hi in self.unwritten[level]
+        )
+
+    def state(self):
+        state = {"written": np.array(self.written, dtype=np.int64)}
+        for level, (lo, hi) in enumerate(self.pending):
+            state[f"lo{level}"] = lo
+            state[f"hi{level}"] = hi
+        return state
+
+    def restore(self, state):
+        # checkpoints are taken right after write(force=True), nothing is unwritten
+        self.written = [int(n) for n in state["written"]]
+        self.pending = [
+            (state[f"lo{level}"], state[f"hi{level}"])
+            for level in range(len(self.written))
+        ]
+        self.unwritten = [[] for level in self.written]
+
+    def add(self, block):
+        self._reduce(0, block, block)
+
+    def _reduce(self, level, lo, hi, final=False):
+        if level == len(self.pending):
+            self.pending.append((self._empty(), self._empty()))
+            self.unwritten.append([])
+            self.written.append(0)
+        lo = np.concatenate([self.pending[level][0], lo], axis=1)
+        hi = np.concatenate([self.pending[level][1], hi], axis=1)
+        n = lo.shape[1] // self.factor * self.factor
+        binLo = lo[:, :n].reshape(self.nChannels, -1, self.factor).min(axis=2)
+        binHi = hi[:, :n].reshape(self.nChannels, -1, self.factor).max(axis=2)
+        if final and n < lo.shape[1]:
+            binLo = np.concatenate([binLo, lo[:, n:].min(axis=1, keepdims=True)], 1)
+            binHi = np.concatenate([binHi, hi[:, n:].max(axis=1, keepdims=True)], 1)
+            n = lo.shape[1]
+        self.pending[level] = (lo[:, n:], hi[:, n:])
+        if binLo.shape[1]:
+            self.unwritten[level].append((binLo, binHi))
+            self._reduce(level + 1, binLo, binHi)
+
+    def write(self, h5, force=False):
+        for level, bins in enumerate(self.unwritten):
+            if not bins:
+                continue
+            n = sum(lo.shape[1] for lo, hi in bins)
+            if n < ENVELOPE_CHUNK and not force:
+                continue
+            for name, column in (("Min", 0), ("Max", 1)):
+                path = f"/3BData/Envelope/{level}/{name}"
+                if path not in h5:
+                    h5.create_dataset(
+                        path,
+                        shape=(self.nChannels, 0),
+                        maxshape=(self.nChannels, None),
+                        chunks=self._chunks(level),
+                        dtype=self.dtype,
+                    )
+                    h5[f"/3BData/Envelope/{level}"].attrs["Factor"] = self.factor ** (
+                        level + 1
+                    )
+                dset = h5[path]
+                # a resumed export writes over whatever followed its checkpoint
+                dset.resize((self.nChannels, self.written[level] + n))
+                dset[:, self.written[level] :] = np.concatenate(
+                    [b[column] for b in bins], axis=1
+                )
+            self.written[level] += n
+            self.unwritten[level] = []
+
+    def finish(self, h5):
+        # the remaining samples of each level go into one last, shorter bin, up to
+        # the first level that ends up with a single bin
+        level = 0
+        while level < len(self.pending):
+            self._reduce(level, self._empty(), self._empty(), final=True)
+            if self._bins(level) <= 1:
+                del self.pending[level + 1 :]
+                del self.unwritten[level + 1 :]
+                del self.written[level + 1 :]
+                break
+            level += 1
+        self.write(h5, force=True)
+        # bins and levels left over from an interrupted run that reached further
+        if "/3BData/Envelope" in h5:
+            for name in list(h5["/3BData/Envelope"]):
+                level = int(name)
+                if level >= len(self.written):
+                    del h5["/3BData/Envelope/" + name]
+                    continue
+                for dset in h5["/3BData/Envelope/" + name].values():
+                    dset.resize((self.nChannels, self.written[level]))
+            h5["/3BData/Envelope"].attrs["Factor"] = self.factor
+            h5["/3BData/Envelope"].attrs["Levels"] = len(self.written)
+
+
+def export_job(recfileName, chs, newSampling, chfileInfo, options):
+    # everything that decides the contents of a _resample_ output
+    source = os.stat(recfileName)
+    return {
+        "source": os.path.basename(recfileName),
+        "size": source.st_size,
+        "mtime": source.st_mtime,
+        "channels": [[int(ch[0]), int(ch[1])] for ch in chs],
+        "newSampling": float(newSampling),
+        "startTime": float(chfileInfo["start"]),
+        "endTime": float(chfileInfo["end"]),
+        "output_units": options["output_units"],
+        "raw_layout": options["raw_layout"],
+        "stats_bands": options["stats_bands"],
+        "envelope_factor": options["envelope_factor"],
+    }
+
+
+def resume_job(dset, job, resampler, stats, nChannels, nFrames):
+    # returns the first window still to do, None when the output is already complete
+    checkpoint = dset.startJob(job, nChannels, nFrames)
+    if checkpoint == "complete":
+        print("Already exported, skipping: ", dset.fileName)
+        return None
+    if checkpoint is None:
+        return 0
+    resampler.restore(checkpoint)
+    if stats is not None:
+        stats.restore(checkpoint["stats"])
+    print("Resuming ", dset.fileName, " from window ", int(checkpoint["window"]))
+    return int(checkpoint["window"])
+
+
+def output_rate_name(newSampling):
+    # the rate part of an output's _resample_<Hz>.brw name
+    return str(int(newSampling))
+
+
+def open_outputs(recfileName, chs, chfileInfo, parameters, options, nFrames):
+    # one writer and resampler per target rate, outputs already complete are left
+    # out of the returned list but their paths are still reported
+    outputs, output_paths = [], []
+    for newSampling in chfileInfo["newSamplings"]:
+        output_path = (
+            recfileName.split(".")[0]
+            + "_resample_"
+            + output_rate_name(newSampling)
+            + ".brw"
+        )
+        output_paths.append(output_path)
+        print("Downsampling File # ", output_path)
+        resampler = StreamResampler(parameters["samplingRate"], newSampling, len(chs))
+        print(f"Mine: {resampler.newSampling}")
+        print(f"Original: {newSampling}")
+        stats = None
+        if options["stats_bands"] is not None:
+            stats = ChannelStats(
+                parameters["samplingRate"], len(chs), options["stats_bands"]
+            )
+        dset = writeBrw(recfileName, output_path, parameters, options)
+        first_window = resume_job(
+            dset,
+            export_job(recfileName, chs, newSampling, chfileInfo, options),
+            resampler,
+            stats,
+            len(chs),
+            resampler.output_length(nFrames),
+        )
+        if first_window is not None:
+            outputs.append(
+                {
+                    "dset": dset,
+                    "resampler": resampler,
+                    "stats": stats,
+                    "first_window": first_window,
+                    "nrecFrame": dset.rawWritten // len(chs),
+                }
+            )
+    # the statistics only depend on the full-rate frames, so they are computed once
+    # for all outputs, continuing from the output resumed the earliest
+    if outputs and outputs[0]["stats"] is not None:
+        stats = min(outputs, key=lambda output: output["first_window"])["stats"]
+        for output in outputs:
+            output["stats"] = stats
+    return outputs, output_paths
+
+
+def write_window(outputs, window, resampled, ind, report):
+    # resampled holds the workers' output block of each output, None for the
+    # outputs resumed past this window
+    for output, res in zip(outputs, resampled):
+        if res is None:
+            continue
+        t = time.time()
+        output["nrecFrame"] += res.shape[1]
+        output["dset"].writeRaw(res[ind, :], typeFlatten="F")
+        output["dset"].checkpoint(window, output["resampler"], output["stats"])
+        add_stage(
+            report,
+            "write",
+            time.time() - t,
+            res.size * np.dtype(output["dset"].rawType).itemsize,
+            res.shape[1],
+        )
+
+
+def close_outputs(outputs, newChs, ind, report):
+    t = time.time()
+    for output in outputs:
+        # the filter tail still holds the last output samples
+        res = output["resampler"].flush()
+        output["nrecFrame"] += res.shape[1]
+        dset = output["dset"]
+        dset.writeRaw(res[ind, :], typeFlatten="F")
+        dset.writeSamplingFreq(output["resampler"].newSampling)
+        dset.witeFrames(output["nrecFrame"])
+        dset.writeChs(newChs)
+        if output["stats"] is not None:
+            dset.writeStats(output["stats"], ind)
+        dset.close()
+    add_stage(report, "close", time.time() - t)
 
 
 def get_chfile_properties(path):
+    return cached_properties(path, "exportCh", lambda: read_chfile_properties(path))
+
+
+def read_chfile_properties(path):
     fileInfo = {}
     h5 = h5py.File(path, "r")
     fileInfo["recFrames"] = h5["/3BRecInfo/3BRecVars/NRecFrames"][0]
     fileInfo["recSampling"] = h5["/3BRecInfo/3BRecVars/SamplingRate"][0]
     fileInfo["newSampling"] = h5["/3BRecInfo/3BRecVars/NewSampling"][0]
+    # every rate listed in NewSampling gets its own output from the same decode.
+    # Outputs are named after the whole Hz, of rates sharing a name only the first
+    # is exported.
+    rates = {}
+    for rate in h5["/3BRecInfo/3BRecVars/NewSampling"][:]:
+        if rates.setdefault(output_rate_name(rate), rate) != rate:
+            print(
+                f"Skipping {rate} Hz, it would overwrite the output of "
+                f"{rates[output_rate_name(rate)]} Hz"
+            )
+    fileInfo["newSamplings"] = list(rates.values())
     # fileInfo['newSampling'] = 1024
     fileInfo["recLength"] = fileInfo["recFrames"] / fileInfo["recSampling"]
     fileInfo["recElectrodeList"] = h5["/3BRecInfo/3BMeaStreams/Raw/Chs"][
@@ -247,7 +1025,35 @@ def get_chfile_properties(path):
     return fileInfo
 
 
+def time_window(recfileName, chfileInfo, parameters):
+    # frames [start_frame, end_frame) picked in the GUI, an end at or before the
+    # start exports up to the end of the recording
+    nFrames = parameters["nRecFrames"]
+    start_frame = max(0, round(chfileInfo["start"] * parameters["samplingRate"]))
+    end_frame = round(chfileInfo["end"] * parameters["samplingRate"])
+    if end_frame <= start_frame:
+        end_frame = nFrames
+    end_frame = min(end_frame, nFrames)
+    print(f"Start time: {chfileInfo['start']}")
+    print(f"End time: {chfileInfo['end']}")
+    print(f"Start frame: {start_frame}")
+    print(f"End frame: {end_frame}")
+    if not start_frame < end_frame <= nFrames:
+        raise ValueError(
+            f"{recfileName}: start time {chfileInfo['start']} s is past the end of "
+            f"the recording ({nFrames / parameters['samplingRate']:.2f} s), "
+            "nothing to export"
+        )
+    return start_frame, end_frame
+
+
 def get_recFile_properties(path, typ):
+    return cached_properties(
+        path, "recording", lambda: read_recFile_properties(path, typ)
+    )
+
+
+def read_recFile_properties(path, typ):
     h5 = h5py.File(path, "r")
     print(typ.decode("utf8"))
     if typ.decode("utf8").lower() == "bw4":
@@ -268,7 +1074,7 @@ def get_recFile_properties(path, typ):
             0
         ]  # number of used bit of the 2 byte coding
         parameters["qLevel"] = (
-            2 ^ parameters["bitDepth"]
+            2 ** parameters["bitDepth"]
         )  # quantized levels corresponds to 2^num of bit to encode the signal
         parameters["fromQLevelToUVolt"] = (
             parameters["maxUVolt"] - parameters["minUVolt"]
@@ -303,7 +1109,7 @@ def get_recFile_properties(path, typ):
             parameters["minUVolt"] = int(-4125)  # in uVolt
             parameters["bitDepth"] = int(12)  # number of used bit of the 2 byte coding
             parameters["qLevel"] = (
-                2 ^ parameters["bitDepth"]
+                2 ** parameters["bitDepth"]
             )  # quantized levels corresponds to 2^num of bit to encode the signal
             parameters["fromQLevelToUVolt"] = (
                 parameters["maxUVolt"] - parameters["minUVolt"]
@@ -329,15 +1135,9 @@ def get_recFile_properties(path, typ):
             coefsChunkLength = (
                 math.ceil(framesChunkLength / pow(2, compressionLevel)) * 2
             )
-            numFrames = 0
-            chIdx = 1
-            coefsPosition = chIdx * coefsChunkLength
-            while coefsPosition < coefsTotalLength:
-                length = int(coefsChunkLength / 2)
-                for i in range(compressionLevel):
-                    length *= 2
-                numFrames += length
-                coefsPosition += coefsChunkLength * nChannels
+            numFrames = wav_frame_count(
+                coefsTotalLength, nChannels, coefsChunkLength, compressionLevel
+            )
 
             parameters["nRecFrames"] = numFrames
             parameters["recordingLength"] = numFrames / samplingRate
@@ -349,7 +1149,7 @@ def get_recFile_properties(path, typ):
             parameters["minUVolt"] = int(-4125)  # in uVolt
             parameters["bitDepth"] = int(12)  # number of used bit of the 2 byte coding
             parameters["qLevel"] = (
-                2 ^ parameters["bitDepth"]
+                2 ** parameters["bitDepth"]
             )  # quantized levels corresponds to 2^num of bit to encode the signal
             parameters["fromQLevelToUVolt"] = (
                 parameters["maxUVolt"] - parameters["minUVolt"]
@@ -359,112 +1159,115 @@ def get_recFile_properties(path, typ):
             ]  # list of the recorded channels
             parameters["numRecElectrodes"] = len(parameters["recElectrodeList"])
 
+    h5.close()
     return parameters
 
 
-def extBW4_WAV(chfileName, recfileName, chfileInfo, parameters):
-    with h5py.File(chfileName) as file:
-        start_time = file["3BRecInfo/3BRecVars/startTime"][0]
-        end_time = file["3BRecInfo/3BRecVars/endTime"][0]
-        print(f"Start time: {start_time}")
-        print(f"End time: {end_time}")
-        file.close()
-
-    start_frame = int(start_time * parameters["samplingRate"])
-    end_frame = int(end_time * parameters["samplingRate"])
-    print(f"Start frame: {start_frame}")
-    print(f"End frame: {end_frame}")
-
-    b = time.time()
-    chs, ind_rec, ind_ch = np.intersect1d(
-        parameters["recElectrodeList"],
-        chfileInfo["recElectrodeList"],
-        return_indices=True,
+def extBW4_WAV(
+    chfileName,
+    recfileName,
+    chfileInfo,
+    parameters,
+    options=None,
+    pool=None,
+    report=None,
+):
+    start_frame, end_frame = time_window(recfileName, chfileInfo, parameters)
+    with h5py.File(recfileName, "r") as file:
+        try:
+            get_WAV_layout(file)
+            unsupported = None
+        except ValueError as e:
+            unsupported = e
+    if unsupported is not None:
+        # BrainWave's own reader still knows the layouts the h5py one does not
+        if brainwave_file() is None:
+            raise unsupported
+        print(unsupported, "\n Reading it through BrainWave instead")
+        return extRAW(
+            recfileName,
+            None,
+            chfileInfo,
+            parameters,
+            options,
+            pool,
+            start_frame,
+            end_frame,
+            report,
+            kind="BrainWave",
+        )
+    return extWAV(
+        recfileName,
+        chfileInfo,
+        parameters,
+        options,
+        pool,
+        start_frame,
+        end_frame,
+        report,
     )
-    newSampling = int(chfileInfo["newSampling"])
-    output_file_name = recfileName.split(".")[0] + "_resample_" + str(newSampling)
-    output_path = output_file_name + ".brw"
-    # print(output_path)
-    parameters["freq_ratio"] = parameters["samplingRate"] / chfileInfo["newSampling"]
-    fs = chfileInfo["newSampling"]  # desired sampling frequency
-    block_size = 1000000
-
-    print("Downsampling File # ", output_path)
-    dset = writeBrw(recfileName, output_path, parameters)
-    dset.createNewBrw()
 
-    newChs = np.zeros(len(chs), dtype=[("Row", "<i2"), ("Col", "<i2")])
-    idx = 0
-    for ch in chs:
-        newChs[idx] = (np.int16(ch[0]), np.int16(ch[1]))
-        idx += 1
-
-    ind = np.lexsort((newChs["Col"], newChs["Row"]))
-    newChs = newChs[ind]
-    consumer = object()
-    data = BrwFile.Open(recfileName)
-    info = data.get_MeaExperimentInfo()
-    dur = int(info.get_TimeDuration().get_TotalSeconds())
-    numReading = int(np.floor(dur * info.get_SamplingRate() / block_size))
 
-    s = time.time()
-    nrecFrame = 0
-    for cnk in tqdm(range(numReading), desc="Export & downsampling Progress"):
-        if start_frame + cnk * block_size >= end_frame:
-            break
-        raw = np.zeros((block_size, len(ind_rec)))
-
-        tmp = data.ReadRawData(
-            int(start_frame + cnk * block_size),
-            block_size,
-            data.get_SourceChannels(),
-            consumer,
-        )
-        # tmp is a 3D array, first index is the well number (in case of mutliwells, for single chip there will be only one well),
-        # the second index is the channel, the third index the time frame
-        count = 0
-        for i in tqdm(ind_rec, desc="Extracting individual channel"):
-            ext = np.fromiter(
-                tmp[0][int(i)], int
-            )  # here values are converted in voltage
-            raw[:, count] = ext[:]
-            count += 1
-
-        raw_resample = downsample_channel(raw, parameters["freq_ratio"])
-        raw_resample = np.transpose(raw_resample)
-
-        nrecFrame += raw_resample.shape[1]
-
-        if cnk <= 0:
-            dset.writeRaw(raw_resample[ind, :], typeFlatten="F")
-            dset.writeSamplingFreq(fs)
-            dset.witeFrames(nrecFrame)
-            dset.writeChs(newChs)
-            dset.close()
-        else:
-            dset.appendBrw(output_path, nrecFrame, raw_resample[ind, :])
-    data.Close()
-    return time.time() - s, output_path
+def extBW4_RAW(
+    chfileName,
+    recfileName,
+    chfileInfo,
+    parameters,
+    options=None,
+    pool=None,
+    report=None,
+):
+    start_frame, end_frame = time_window(recfileName, chfileInfo, parameters)
+    return extRAW(
+        recfileName,
+        "/3BData/Raw",
+        chfileInfo,
+        parameters,
+        options,
+        pool,
+        start_frame,
+        end_frame,
+        report,
+    )
 
 
-def extBW4_RAW(chfileName, recfileName, chfileInfo, parameters):
+def extRAW(
+    recfileName,
+    dataset,
+    chfileInfo,
+    parameters,
+    options=None,
+    pool=None,
+    start_frame=0,
+    end_frame=None,
+    report=None,
+    kind="RAW",
+):
+    # BW4 and BW5 RAW recordings only differ in where the Raw stream is stored,
+    # only frames [start_frame, end_frame) are read. Stage timings are added to
+    # report when one is passed in. kind "BrainWave" reads the frames through
+    # BrainWave's .NET reader instead of the dataset.
+    options = get_export_options(options)
+    stats = report if report is not None else job_report()
+    t = time.time()
     chs, ind_rec, ind_ch = np.intersect1d(
         parameters["recElectrodeList"],
         chfileInfo["recElectrodeList"],
         return_indices=True,
     )
-    newSampling = int(chfileInfo["newSampling"])
-    output_file_name = recfileName.split(".")[0] + "_resample_" + str(newSampling)
-    output_path = output_file_name + ".brw"
-    # print(parameters)
-    parameters["freq_ratio"] = parameters["samplingRate"] / chfileInfo["newSampling"]
-    fs = chfileInfo["newSampling"]  # desired sampling frequency
-    block_size = 100000
-
-    chunks = np.arange(block_size, parameters["nRecFrames"], block_size)
-    print("Downsampling File #", output_path)
-    dset = writeBrw(recfileName, output_path, parameters)
-    dset.createNewBrw()
+    block_size = options["window_frames"]
+    nWorkers = options["workers"] or os.cpu_count() or 1
+    memmap = None
+    if options["raw_memmap"] and kind == "RAW":
+        with h5py.File(recfileName, "r") as file:
+            memmap = raw_layout(file[dataset], parameters["numRecElectrodes"])
+
+    if end_frame is None:
+        end_frame = parameters["nRecFrames"]
+    start_frame = min(start_frame, end_frame)
+    window_frames = split_range(
+        start_frame, end_frame, math.ceil((end_frame - start_frame) / block_size)
+    )
 
     newChs = np.zeros(len(chs), dtype=[("Row", "<i2"), ("Col", "<i2")])
     idx = 0
@@ -475,244 +1278,690 @@ def extBW4_RAW(chfileName, recfileName, chfileInfo, parameters):
     ind = np.lexsort((newChs["Col"], newChs["Row"]))
     newChs = newChs[ind]
 
-    start = 0
-    h5 = h5py.File(recfileName, "r")
-    idx_a = ind_rec.copy()
-    idd = []
-    for i in range(block_size):
-        idd.extend(idx_a)
-        idx_a = idx_a + parameters["numRecElectrodes"]
+    # each window is split into time blocks that the workers read side by side
+    windows = [
+        [
+            {
+                "kind": kind,
+                "recfileName": recfileName,
+                "dataset": dataset,
+                "nRecElectrodes": parameters["numRecElectrodes"],
+                "channel_index": ind_rec,
+                "memmap": memmap,
+                "first": first_frame,
+                "last": last_frame,
+                "out_start": first_frame - first_window_frame,
+            }
+            for first_frame, last_frame in split_range(
+                first_window_frame, last_window_frame, nWorkers
+            )
+        ]
+        for first_window_frame, last_window_frame in window_frames
+    ]
+    add_stage(stats, "probe", time.time() - t)
 
     s = time.time()
-    nrecFrame = 0
-    for cnk in tqdm(chunks, desc="Downsampling & Export Progress"):
-        end = cnk * parameters["numRecElectrodes"]
-        data = np.array(h5["/3BData/Raw"][start:end])
-        data = data[idd]
-        data = data.reshape(block_size, len(chs))
-
-        data_resample = downsample_channel(data, parameters["freq_ratio"])
-        resamp_frame = data_resample.shape[0]
-
-        nrecFrame += resamp_frame
-        res = np.zeros((len(chs), resamp_frame))
-
-        ch = 0
-        for channel in range(res.shape[0]):
-            res[channel, :] = data_resample[:, ch]
-            ch += 1
-
-        if cnk <= block_size:
-            dset.writeRaw(res[ind, :], typeFlatten="F")
-            dset.writeSamplingFreq(fs)
-            dset.witeFrames(nrecFrame)
-            dset.writeChs(newChs)
-            dset.close()
-        else:
-            dset.appendBrw(output_path, nrecFrame, res[ind, :])
+    with worker_pool(pool, options) as pool:
+        outputs, output_paths = open_outputs(
+            recfileName, chs, chfileInfo, parameters, options, end_frame - start_frame
+        )
+        if not outputs:
+            return 0, output_paths
+        first_window = min(output["first_window"] for output in outputs)
 
-        start = end
-    h5.close()
+        for window, resampled in enumerate(
+            tqdm(
+                stream_windows(
+                    pool,
+                    windows[first_window:],
+                    [(0, last - first) for first, last in window_frames[first_window:]],
+                    outputs,
+                    len(chs),
+                    block_size,
+                    nWorkers,
+                    stats,
+                ),
+                initial=first_window,
+                total=len(windows),
+                desc="Downsampling & Export Progress",
+            ),
+            first_window + 1,
+        ):
+            write_window(outputs, window, resampled, ind, stats)
+
+        close_outputs(outputs, newChs, ind, stats)
+
+    print_transport_stats(stats)
     totTime = time.time() - s
 
-    return totTime, output_path
+    return totTime, output_paths
 
 
-def reconstruct_WAV_signal(
-    recfileName,
-    channel_index,
-    samplingRate,
-    nChannels,
-    coefsTotalLength,
-    compressionLevel,
-    framesChunkLength,
-    coefsChunkLength,
+def read_raw_block(
+    dset, first_frame, last_frame, nRecElectrodes, channel_index, report=None
 ):
-    data = []
-    with h5py.File(recfileName) as file:
-        coefs_position = channel_index * coefsChunkLength
-        while coefs_position < coefsTotalLength:
-            coefs = file["Well_A1/WaveletBasedEncodedRaw"][
-                coefs_position : coefs_position + coefsChunkLength
-            ]
-            length = int(len(coefs) / 2)
-
-            approx, details = coefs[:length], coefs[length:]
-            approx = np.roll(approx, -5)
-            details = np.roll(details, -5)
-
-            length = int(len(coefs) / 2)
-            frames = pywt.idwt(approx, details, "sym7", "periodization")
-            length *= 2
-            for i in range(1, compressionLevel):
-                frames = pywt.idwt(frames[:length], None, "sym7", "periodization")
-                length *= 2
-            data.extend(frames[2:-2])
-            coefs_position += coefsChunkLength * nChannels
+    # the flat Raw stream is frame-interleaved, i.e. a (frames, nRecElectrodes) array
+    nFrames = last_frame - first_frame
+    report = report if report is not None else job_report()
+    t = time.time()
+    if np.all(np.diff(channel_index) == 1):
+        # a contiguous run of channels is picked out by HDF5 with one hyperslab
+        fspace = dset.id.get_space()
+        fspace.select_hyperslab(
+            (first_frame * nRecElectrodes + int(channel_index[0]),),
+            (nFrames,),
+            (nRecElectrodes,),
+            (len(channel_index),),
+        )
+        data = np.empty((nFrames, len(channel_index)), dtype=dset.dtype)
+        dset.id.read(h5py.h5s.create_simple((data.size,)), fspace, data)
+        # HDF5 does the channel gather as part of the read here
+        add_stage(report, "read", time.time() - t, data.nbytes, nFrames)
+        return data
+
+    data = dset[first_frame * nRecElectrodes : last_frame * nRecElectrodes]
+    add_stage(report, "read", time.time() - t, data.nbytes, nFrames)
+    t = time.time()
+    data = data.reshape(nFrames, nRecElectrodes)[:, channel_index]
+    add_stage(report, "gather", time.time() - t, data.nbytes, nFrames)
     return data
 
 
-def extract_channel(args):
-    (
-        i,
-        recfileName,
-        samplingRate,
-        nChannels,
-        coefsTotalLength,
-        compressionLevel,
-        framesChunkLength,
-        coefsChunkLength,
-        chfileInfo,
-    ) = args
-    channel_data = reconstruct_WAV_signal(
-        recfileName,
-        i,
-        samplingRate,
-        nChannels,
-        coefsTotalLength,
-        compressionLevel,
-        framesChunkLength,
-        coefsChunkLength,
+def get_WAV_layout(h5):
+    layout = {}
+    if "Well_A1" in h5:
+        layout["dataset"] = "Well_A1/WaveletBasedEncodedRaw"
+        coefs = h5[layout["dataset"]]
+        settings = coefs.attrs
+        layout["samplingRate"] = h5.attrs["SamplingRate"]
+        layout["nChannels"] = len(h5["Well_A1/StoredChIdxs"])
+    else:
+        # BW4 is read as the same chunked sym7 coefficients next to where Raw would
+        # be, with the settings on the dataset or on the stream group. This has not
+        # been checked against a BrainWave 4 recording, so whatever a file lacks is
+        # reported by name.
+        layout["dataset"] = "/3BData/WaveletCoefficients"
+        group = "/3BRecInfo/3BMeaStreams/WaveletCoefficients"
+        if layout["dataset"] not in h5:
+            raise ValueError(
+                f"{h5.filename}: unsupported BW4 wavelet layout, "
+                f"no {layout['dataset']} dataset"
+            )
+        coefs = h5[layout["dataset"]]
+        settings = dict(h5[group].attrs) if group in h5 else {}
+        settings.update(coefs.attrs)
+        for name in ("CompressionLevel", "DataChunkLength"):
+            if name not in settings:
+                raise ValueError(
+                    f"{h5.filename}: unsupported BW4 wavelet layout, no {name} "
+                    f"attribute on {layout['dataset']} or {group}"
+                )
+        layout["samplingRate"] = h5["/3BRecInfo/3BRecVars/SamplingRate"][0]
+        layout["nChannels"] = len(h5["/3BRecInfo/3BMeaStreams/WaveletCoefficients/Chs"])
+    layout["coefsTotalLength"] = len(coefs)
+    layout["compressionLevel"] = int(settings["CompressionLevel"])
+    layout["framesChunkLength"] = int(settings["DataChunkLength"])
+    layout["coefsChunkLength"] = (
+        math.ceil(layout["framesChunkLength"] / pow(2, layout["compressionLevel"])) * 2
     )
-    original_sampling_rate = samplingRate
-    desired_sampling_rate = chfileInfo["newSampling"]
-    downsample_factor = math.floor(original_sampling_rate / desired_sampling_rate)
-    new_sampling_rate = original_sampling_rate / downsample_factor
-    downsampled_channel_data = channel_data[::downsample_factor]
-    return downsampled_channel_data
-
-
-def extBW5_WAV(chfileName, recfileName, chfileInfo, parameters):
-    # open the BRW file
-    samplingRate = None
-    nChannels = None
-    coefsTotalLength = None
-    compressionLevel = None
-    framesChunkLength = None
-    coefsChunkLength = None
-    with h5py.File(chfileName) as file:
-        start_time = file["3BRecInfo/3BRecVars/startTime"][0]
-        end_time = file["3BRecInfo/3BRecVars/endTime"][0]
-        print(f"Start time: {start_time}")
-        print(f"End time: {end_time}")
-        file.close()
+    # one time block holds the coefficients of every stored channel back to back
+    layout["coefsBlockLength"] = layout["coefsChunkLength"] * layout["nChannels"]
+    layout["numChunks"] = layout["coefsTotalLength"] // layout["coefsBlockLength"]
+    # frames left per chunk after the reconstruction edges are trimmed
+    layout["framesPerChunk"] = (
+        int(layout["coefsChunkLength"] / 2) * pow(2, layout["compressionLevel"]) - 4
+    )
+    return layout
+
+
+def reconstruct_WAV_chunks(coefs, compressionLevel):
+    # coefs holds one chunk per row along the last axis, all rows are inverted at once
+    length = int(coefs.shape[-1] / 2)
+
+    approx, details = coefs[..., :length], coefs[..., length:]
+    approx = np.roll(approx, -5, axis=-1)
+    details = np.roll(details, -5, axis=-1)
+
+    frames = pywt.idwt(approx, details, "sym7", "periodization", axis=-1)
+    length *= 2
+    for i in range(1, compressionLevel):
+        frames = pywt.idwt(frames[..., :length], None, "sym7", "periodization", axis=-1)
+        length *= 2
+    return frames[..., 2:-2]
+
+
+def decode_WAV_blocks(h5, channel_index, layout, first_chunk, last_chunk, report=None):
+    # a single contiguous read covers chunks [first_chunk, last_chunk) of all channels
+    report = report if report is not None else job_report()
+    nFrames = (last_chunk - first_chunk) * layout["framesPerChunk"]
+    blockLength = layout["coefsBlockLength"]
+    t = time.time()
+    coefs = h5[layout["dataset"]][first_chunk * blockLength : last_chunk * blockLength]
+    add_stage(report, "read", time.time() - t, coefs.nbytes, nFrames)
+
+    # (channels, chunks, coefficients) so each channel's chunks end up contiguous,
+    # the inverse transforms then run in float32
+    t = time.time()
+    coefs = coefs.reshape(
+        last_chunk - first_chunk, layout["nChannels"], layout["coefsChunkLength"]
+    )
+    coefs = np.transpose(coefs[:, channel_index, :], (1, 0, 2)).astype(np.float32)
+    add_stage(report, "gather", time.time() - t, coefs.nbytes, nFrames)
 
-    with h5py.File(recfileName) as file:
-        # collect experiment information
-        samplingRate = file.attrs["SamplingRate"]
-        nChannels = len(file["Well_A1/StoredChIdxs"])
-        coefsTotalLength = len(file["Well_A1/WaveletBasedEncodedRaw"])
-        compressionLevel = file["Well_A1/WaveletBasedEncodedRaw"].attrs[
-            "CompressionLevel"
-        ]
-        framesChunkLength = file["Well_A1/WaveletBasedEncodedRaw"].attrs[
-            "DataChunkLength"
-        ]
-        coefsChunkLength = math.ceil(framesChunkLength / pow(2, compressionLevel)) * 2
-        file.close()
+    t = time.time()
+    data = reconstruct_WAV_chunks(coefs, layout["compressionLevel"])
+    data = data.reshape(len(channel_index), -1)
+    add_stage(report, "decode", time.time() - t, data.nbytes, nFrames)
+    return data
 
-    chs, ind_rec, ind_ch = np.intersect1d(
-        parameters["recElectrodeList"],
-        chfileInfo["recElectrodeList"],
-        return_indices=True,
+
+def decode_WAV_channel(h5, channel, layout, first_chunk, last_chunk):
+    # chunks [first_chunk, last_chunk) of one stored channel, e.g. for a preview.
+    # Channel c's part of time block k starts at k * blockLength + c * cc, so a
+    # single strided hyperslab picks them out without reading the other channels.
+    last_chunk = min(last_chunk, layout["numChunks"])
+    if last_chunk <= first_chunk:
+        return np.zeros(0, dtype=np.float32)
+    coefsChunkLength = layout["coefsChunkLength"]
+    dset = h5[layout["dataset"]]
+    fspace = dset.id.get_space()
+    fspace.select_hyperslab(
+        (first_chunk * layout["coefsBlockLength"] + channel * coefsChunkLength,),
+        (last_chunk - first_chunk,),
+        (layout["coefsBlockLength"],),
+        (coefsChunkLength,),
     )
-    newSampling = int(chfileInfo["newSampling"])
-    output_file_name = recfileName.split(".")[0] + "_resample_" + str(newSampling)
-    output_path = output_file_name + ".brw"
-    parameters["freq_ratio"] = parameters["samplingRate"] / chfileInfo["newSampling"]
-    fs = chfileInfo["newSampling"]  # desired sampling frequency
+    coefs = np.empty((last_chunk - first_chunk, coefsChunkLength), dtype=dset.dtype)
+    dset.id.read(h5py.h5s.create_simple((coefs.size,)), fspace, coefs)
+    return reconstruct_WAV_chunks(
+        coefs.astype(np.float32), layout["compressionLevel"]
+    ).reshape(-1)
+
+
+# shared windows and output blocks this worker has attached, by segment name
+shared_windows = {}
+
+
+def attach_shared_window(name, shape, dtype, segments):
+    # segments lists every shared memory segment of the running job, the ones
+    # attached for finished jobs are closed first
+    for old in [old for old in shared_windows if old not in segments]:
+        memory, window = shared_windows.pop(old)
+        del window
+        memory.close()
+    if name not in shared_windows:
+        memory = shared_memory.SharedMemory(name=name)
+        shared_windows[name] = (
+            memory,
+            np.ndarray(shape, dtype=dtype, buffer=memory.buf),
+        )
+    return shared_windows[name][1]
 
-    print("Downsampling File # ", output_path)
-    dset = writeBrw(recfileName, output_path, parameters)
-    dset.createNewBrw()
 
-    newChs = np.zeros(len(chs), dtype=[("Row", "<i2"), ("Col", "<i2")])
-    idx = 0
-    for ch in chs:
-        newChs[idx] = (np.int16(ch[0]), np.int16(ch[1]))
-        idx += 1
+def raw_layout(dset, nRecElectrodes):
+    # file offset, dtype and frame count of a Raw stream that can be memory mapped,
+    # None when HDF5 has to do the reading (chunked, filtered or not yet allocated)
+    plist = dset.id.get_create_plist()
+    if plist.get_layout() != h5py.h5d.CONTIGUOUS or plist.get_nfilters() > 0:
+        return None
+    if dset.file.driver not in ("sec2", "stdio", "windows"):
+        return None
+    offset = dset.id.get_offset()
+    if offset is None or dset.dtype.kind not in "iuf":
+        return None
+    return offset, dset.dtype.str, dset.shape[0] // nRecElectrodes
 
-    ind = np.lexsort((newChs["Col"], newChs["Row"]))
-    newChs = newChs[ind]
-    idx_a = ind_rec.copy()
-    print(idx_a)
-    data = BrwFile.Open(recfileName)
 
-    s = time.time()
+# memory maps of Raw streams this worker has opened, oldest first
+raw_maps = {}
 
-    args = [
-        (
-            i,
+
+def attach_raw_map(recfileName, offset, dtype, nFrames, nRecElectrodes):
+    key = (recfileName, offset, dtype, nFrames)
+    if key not in raw_maps:
+        while len(raw_maps) >= 2:
+            del raw_maps[next(iter(raw_maps))]
+        raw_maps[key] = np.memmap(
             recfileName,
-            samplingRate,
-            nChannels,
-            coefsTotalLength,
-            compressionLevel,
-            framesChunkLength,
-            coefsChunkLength,
-            chfileInfo,
+            dtype=dtype,
+            mode="r",
+            offset=offset,
+            shape=(nFrames, nRecElectrodes),
+        )
+    return raw_maps[key]
+
+
+def read_raw_map(raw, first_frame, last_frame, channel_index):
+    # a contiguous run of channels stays a view of the page cache, other
+    # selections are gathered into a copy
+    block = raw[first_frame:last_frame]
+    if len(channel_index) and np.all(np.diff(channel_index) == 1):
+        return block[:, channel_index[0] : channel_index[-1] + 1]
+    return block[:, channel_index]
+
+
+@functools.lru_cache(maxsize=1)
+def brainwave_file():
+    # BrainWave's BrwFile class, None where pythonnet or BrainWave is not installed
+    try:
+        import clr  # pip install pythonnet
+
+        clr.AddReference(BRAINWAVE_IO_DLL)
+        from _3Brain.BrainWave.IO import BrwFile
+    except Exception:
+        return None
+    return BrwFile
+
+
+def read_brainwave_block(recfileName, first_frame, last_frame, channel_index):
+    # (channels, frames) of the selected channels, read the way the exporter read
+    # BW4 wavelet files before it had its own decoder
+    data = brainwave_file().Open(recfileName)
+    try:
+        raw = data.ReadRawData(
+            int(first_frame),
+            int(last_frame - first_frame),
+            data.get_SourceChannels(),
+            object(),
+        )
+        # raw is indexed [well][channel][frame], a single chip has one well
+        return np.array(
+            [np.fromiter(raw[0][int(i)], int) for i in channel_index],
+            dtype=np.float32,
+        )
+    finally:
+        data.Close()
+
+
+def read_block(args):
+    # the frames go after the window's prefix, which holds the resampler history
+    window = attach_shared_window(*args["window"], args["segments"])[
+        :, args["prefix"] :
+    ]
+    report = job_report()
+    if args["kind"] == "RAW" and args["memmap"] is not None:
+        raw = attach_raw_map(
+            args["recfileName"], *args["memmap"], args["nRecElectrodes"]
+        )
+        # the pages are read from disk as the copy into the window touches them
+        t = time.time()
+        data = read_raw_map(raw, args["first"], args["last"], args["channel_index"]).T
+        window[:, args["out_start"] : args["out_start"] + data.shape[1]] = data
+        add_stage(report, "read", time.time() - t, data.nbytes, data.shape[1])
+        return data.shape[1], report["stages"]
+
+    if args["kind"] == "BrainWave":
+        t = time.time()
+        data = read_brainwave_block(
+            args["recfileName"], args["first"], args["last"], args["channel_index"]
+        )
+        window[:, args["out_start"] : args["out_start"] + data.shape[1]] = data
+        add_stage(report, "read", time.time() - t, data.nbytes, data.shape[1])
+        return data.shape[1], report["stages"]
+
+    with h5py.File(args["recfileName"], "r") as file:
+        if args["kind"] == "WAV":
+            data = decode_WAV_blocks(
+                file,
+                args["channel_index"],
+                args["layout"],
+                args["first"],
+                args["last"],
+                report,
+            )
+        else:
+            data = read_raw_block(
+                file[args["dataset"]],
+                args["first"],
+                args["last"],
+                args["nRecElectrodes"],
+                args["channel_index"],
+                report,
+            ).T
+    # only the frame count and stage timings go back through the pipe, the data
+    # stays in place
+    window[:, args["out_start"] : args["out_start"] + data.shape[1]] = data
+    return data.shape[1], report["stages"]
+
+
+def resample_block(args):
+    # resamples the channels [first, last) of one shared window for every output
+    # still being written and updates their statistics. The frames before the span
+    # are the resampler history the parent copied into the prefix, the output goes
+    # into each output's block.
+    window = attach_shared_window(*args["window"], args["segments"])
+    first, last = args["channels"]
+    lo, hi = (args["prefix"] + frame for frame in args["span"])
+    frames = window[first:last, lo:hi]
+    report = job_report()
+    results = []
+    for output in args["outputs"]:
+        t = time.time()
+        resampler = StreamResampler(*output["rates"], last - first)
+        kept = output["state"]["nIn"] - output["state"]["bufferStart"]
+        resampler.restore(
+            dict(output["state"], buffer=window[first:last, lo - kept : lo])
+        )
+        res = resampler.process(frames)
+        block = attach_shared_window(*output["block"], args["segments"])
+        block[first:last, : res.shape[1]] = res
+        add_stage(report, "resample", time.time() - t, frames.nbytes, hi - lo)
+        state = resampler.state()
+        del state["buffer"]
+        results.append((res.shape[1], state))
+
+    # the statistics of the group, once for all outputs
+    statsState = None
+    if args["stats"] is not None:
+        t = time.time()
+        samplingRate, bands, statsState = args["stats"]
+        stats = ChannelStats(samplingRate, last - first, bands)
+        stats.restore(statsState)
+        stats.update(frames)
+        statsState = stats.state()
+        add_stage(report, "stats", time.time() - t, frames.nbytes, hi - lo)
+    return results, statsState, report["stages"]
+
+
+def stream_windows(
+    pool, windows, spans, outputs, nChannels, window_frames, nGroups, stats
+):
+    # windows is a list of read_block task lists, one list per time window, and
+    # spans the [lo, hi) frames of each window that belong to the export. Once a
+    # window is read, the workers resample it for every output and update the
+    # statistics, one channel group each, then read the next window into the other
+    # shared window while the caller writes. Yields the resampled blocks of each
+    # window, None for the outputs resumed past it.
+    if not windows:
+        # a resumed output whose last window is already on disk only needs closing
+        return
+    # the windows start with a prefix that takes the frames the resamplers still
+    # need from the previous window, or hold in a checkpoint saved with a longer
+    # history
+    prefix = max(
+        max(output["resampler"].history(), output["resampler"].buffer.shape[1])
+        for output in outputs
+    )
+    shape = (nChannels, prefix + window_frames)
+    shapes = [shape, shape] + [
+        (nChannels, output["resampler"].output_length(window_frames))
+        for output in outputs
+    ]
+    memories = [
+        shared_memory.SharedMemory(
+            create=True,
+            size=max(1, int(np.prod(size)) * np.dtype(np.float32).itemsize),
         )
-        for i in idx_a
+        for size in shapes
+    ]
+    arrays = [
+        np.ndarray(size, dtype=np.float32, buffer=memory.buf)
+        for size, memory in zip(shapes, memories)
     ]
+    segments = tuple(memory.name for memory in memories)
+    groups = split_range(0, nChannels, nGroups)
+    first_window = min(output["first_window"] for output in outputs)
+    # shared by all outputs, see open_outputs
+    channelStats = outputs[0]["stats"]
+
+    def dispatch(i):
+        for task in windows[i]:
+            task["window"] = (memories[i % 2].name, shape, np.float32)
+            task["prefix"] = prefix
+            task["segments"] = segments
+        return pool.map_async(read_block, windows[i])
+
+    def resample(i, active):
+        lo, hi = spans[i]
+        window = arrays[i % 2]
+        specs = []
+        for k in active:
+            resampler = outputs[k]["resampler"]
+            window[:, prefix + lo - resampler.buffer.shape[1] : prefix + lo] = (
+                resampler.buffer
+            )
+            state = resampler.state()
+            del state["buffer"]
+            specs.append(
+                {
+                    "rates": resampler.rates,
+                    "state": state,
+                    "block": (memories[2 + k].name, shapes[2 + k], np.float32),
+                }
+            )
+        return pool.map_async(
+            resample_block,
+            [
+                {
+                    "window": (memories[i % 2].name, shape, np.float32),
+                    "segments": segments,
+                    "prefix": prefix,
+                    "span": spans[i],
+                    "channels": channels,
+                    "outputs": specs,
+                    "stats": (
+                        None
+                        if channelStats is None
+                        else (
+                            channelStats.samplingRate,
+                            channelStats.bands.tolist(),
+                            channelStats.groupState(*channels),
+                        )
+                    ),
+                }
+                for channels in groups
+            ],
+        )
 
-    with Pool() as pool:
-        results = list(
-            tqdm(
-                pool.map(extract_channel, args),
-                total=len(args),
-                desc="Extracting channels",
+    pending = processing = None
+    try:
+        pending = dispatch(0)
+        for i in range(len(windows)):
+            t = time.time()
+            for _, stages in pending.get():
+                merge_stages(stats, stages)
+            # window counts from 1, outputs resumed past it already hold its samples
+            active = [
+                k
+                for k, output in enumerate(outputs)
+                if first_window + i + 1 > output["first_window"]
+            ]
+            processing = resample(i, active)
+            # the reads of the next window queue up behind the resampling
+            pending = dispatch(i + 1) if i + 1 < len(windows) else None
+            results = processing.get()
+            processing = None
+            # time the parent sat idle waiting for the workers
+            add_stage(stats, "wait", time.time() - t)
+
+            lo, hi = (prefix + frame for frame in spans[i])
+            window = arrays[i % 2]
+            resampled = [None] * len(outputs)
+            for j, k in enumerate(active):
+                count, state = results[0][0][j]
+                resampler = outputs[k]["resampler"]
+                kept = state["nIn"] - state["bufferStart"]
+                # the parent keeps its own copy of the history for checkpoints and
+                # the final flush
+                resampler.restore(dict(state, buffer=window[:, hi - kept : hi].copy()))
+                resampled[k] = arrays[2 + k][:, :count]
+            for channels, (_, state, stages) in zip(groups, results):
+                if channelStats is not None:
+                    channelStats.restoreGroup(*channels, state)
+                merge_stages(stats, stages)
+            stats["transport_bytes"] += window[:, lo:hi].nbytes + sum(
+                block.nbytes for block in resampled if block is not None
             )
+            yield resampled
+    finally:
+        for result in (pending, processing):
+            if result is not None:
+                result.wait()
+        arrays.clear()
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+
+
+# export stages in pipeline order. read, gather, decode, resample and stats run in
+# the workers and are summed over them, wait is the time the parent spent waiting
+# for workers.
+STAGES = (
+    "probe",
+    "read",
+    "decode",
+    "gather",
+    "wait",
+    "resample",
+    "stats",
+    "write",
+    "close",
+)
+
+
+def job_report():
+    return {
+        "stages": {
+            stage: {"seconds": 0.0, "bytes": 0, "frames": 0} for stage in STAGES
+        },
+        "transport_bytes": 0,
+        # estimated parent time the list pipe would have cost, WAV jobs only
+        "pipe_seconds": None,
+    }
+
+
+def add_stage(report, stage, seconds, nbytes=0, frames=0):
+    entry = report["stages"][stage]
+    entry["seconds"] += seconds
+    entry["bytes"] += int(nbytes)
+    entry["frames"] += int(frames)
+
+
+def merge_stages(report, stages):
+    for stage, entry in stages.items():
+        add_stage(report, stage, entry["seconds"], entry["bytes"], entry["frames"])
+
+
+def stage_rate(amount, seconds):
+    return f"{amount / seconds:.1f}" if amount and seconds > 0 else "-"
+
+
+def print_stage_table(stages, totTime):
+    header = f"{'stage':<9} {'seconds':>9} {'share':>6} {'MB':>10} {'MB/s':>9} {'frames/s':>11}"
+    print(header)
+    print("-" * len(header))
+    for stage in STAGES:
+        entry = stages[stage]
+        print(
+            f"{stage:<9} {entry['seconds']:>9.2f} "
+            f"{entry['seconds'] / max(totTime, 1e-9):>6.0%} "
+            f"{entry['bytes'] / 1e6:>10.1f} "
+            f"{stage_rate(entry['bytes'] / 1e6, entry['seconds']):>9} "
+            f"{stage_rate(entry['frames'], entry['seconds']):>11}"
         )
+    print("(read, gather, decode, resample and stats are summed over the workers)")
 
-    original_sampling_rate = parameters["samplingRate"]
-    desired_sampling_rate = chfileInfo["newSampling"]
-    downsample_factor = math.floor(original_sampling_rate / desired_sampling_rate)
-    new_sampling_rate = original_sampling_rate / downsample_factor
-    print(f"Mine: {new_sampling_rate}")
-    print(f"Original: {fs}")
 
-    chunk_size = 100000  # Adjust the chunk size as needed
-    nrecFrame = len(results[0])
+def print_transport_stats(stats):
+    print(
+        f"Shared-memory transport: {stats['transport_bytes'] / 1e6:.1f} MB kept out of "
+        "the worker pipe"
+    )
+    if stats["pipe_seconds"] is not None:
+        print(
+            f"~{stats['pipe_seconds']:.2f} s of parent-side unpickling saved over "
+            "returning channels as lists"
+        )
 
-    for i in range(0, nrecFrame, chunk_size):
-        start = i
-        end = min(i + chunk_size, nrecFrame)
 
-        raw_chunk = [results[j][start:end] for j in range(len(results))]
-        raw_chunk = np.array(raw_chunk)
+# values in the payload pipe_seconds times, about one channel of a long recording.
+# Never fewer than PIPE_MIN_VALUES so the timer resolution does not dominate.
+PIPE_SAMPLE_VALUES = 2**20
+PIPE_MIN_VALUES = 2**16
+
+
+def pipe_seconds(nValues, channelValues):
+    # parent time to unpickle nValues floats returned as one Python list per
+    # channel, the way the WAV workers sent their channels before shared windows.
+    # Only loads() is timed, building and pickling the list was the workers' work.
+    n = min(max(channelValues, PIPE_MIN_VALUES), PIPE_SAMPLE_VALUES)
+    payload = pickle.dumps(np.linspace(-1.0, 1.0, n).tolist())
+    seconds = []
+    for _ in range(3):
+        t = time.perf_counter()
+        pickle.loads(payload)
+        seconds.append(time.perf_counter() - t)
+    return min(seconds) * nValues / n
 
-        if i == 0:
-            dset.writeRaw(raw_chunk, typeFlatten="F")
-            dset.writeSamplingFreq(new_sampling_rate)
-            dset.witeFrames(nrecFrame)
-            dset.writeChs(newChs)
-        else:
-            dset.appendBrw(output_path, end, raw_chunk)
 
-    dset.close()
-    data.Close()
+def split_range(first, last, nParts):
+    step = max(1, math.ceil((last - first) / max(nParts, 1)))
+    return [(i, min(i + step, last)) for i in range(first, last, step)]
 
-    return time.time() - s, output_path
 
+def worker_pool(pool, options):
+    # jobs run inside the batch's warm pool, or start their own when run alone
+    if pool is not None:
+        return contextlib.nullcontext(pool)
+    return start_pool(options["workers"])
+
+
+def start_pool(workers):
+    if os.name == "posix":
+        # forked workers must share the parent's resource tracker, one they start
+        # themselves reports the parent's shared windows as leaked on exit
+        resource_tracker.ensure_running()
+    return Pool(workers)
+
+
+def extBW5_WAV(
+    chfileName,
+    recfileName,
+    chfileInfo,
+    parameters,
+    options=None,
+    pool=None,
+    report=None,
+):
+    start_frame, end_frame = time_window(recfileName, chfileInfo, parameters)
+    return extWAV(
+        recfileName,
+        chfileInfo,
+        parameters,
+        options,
+        pool,
+        start_frame,
+        end_frame,
+        report,
+    )
+
+
+def extWAV(
+    recfileName,
+    chfileInfo,
+    parameters,
+    options=None,
+    pool=None,
+    start_frame=0,
+    end_frame=None,
+    report=None,
+):
+    # BW4 and BW5 wavelet recordings share the chunked coefficient layout, only
+    # frames [start_frame, end_frame) are exported. Stage timings are added to
+    # report when one is passed in.
+    options = get_export_options(options)
+    stats = report if report is not None else job_report()
+    t = time.time()
+    with h5py.File(recfileName) as file:
+        # collect experiment information
+        layout = get_WAV_layout(file)
+        file.close()
 
-def extBW5_RAW(chfileName, recfileName, chfileInfo, parameters):
     chs, ind_rec, ind_ch = np.intersect1d(
         parameters["recElectrodeList"],
         chfileInfo["recElectrodeList"],
         return_indices=True,
     )
-    newSampling = int(chfileInfo["newSampling"])
-    output_file_name = recfileName.split(".")[0] + "_resample_" + str(newSampling)
-    output_path = output_file_name + ".brw"
-    parameters["freq_ratio"] = parameters["samplingRate"] / chfileInfo["newSampling"]
-    fs = chfileInfo["newSampling"]  # desired sampling frequency
-    block_size = 100000
-
-    chunks = np.arange(block_size, parameters["nRecFrames"], block_size)
-    print("Downsampling File #", output_path)
-    dset = writeBrw(recfileName, output_path, parameters)
-    dset.createNewBrw()
-
     newChs = np.zeros(len(chs), dtype=[("Row", "<i2"), ("Col", "<i2")])
     idx = 0
     for ch in chs:
@@ -721,51 +1970,127 @@ def extBW5_RAW(chfileName, recfileName, chfileInfo, parameters):
 
     ind = np.lexsort((newChs["Col"], newChs["Row"]))
     newChs = newChs[ind]
-
-    start = 0
-    h5 = h5py.File(recfileName, "r")
     idx_a = ind_rec.copy()
-    idd = []
-    for i in range(block_size):
-        idd.extend(idx_a)
-        idx_a = idx_a + parameters["numRecElectrodes"]
+    print(idx_a)
 
     s = time.time()
-    nrecFrame = 0
-
-    for cnk in tqdm(chunks, desc="Downsampling & Export Progress"):
-        end = int(cnk * float(parameters["numRecElectrodes"]))
-        data = np.array(h5["Well_A1/Raw"][start:end])
-        data = data[idd]
-        data = data.reshape(block_size, len(chs))
-
-        data_resample = downsample_channel(data, parameters["freq_ratio"])
-        resamp_frame = data_resample.shape[0]
-
-        nrecFrame += resamp_frame
-        res = np.zeros((len(chs), resamp_frame))
-
-        ch = 0
-        for channel in range(res.shape[0]):
-            res[channel, :] = data_resample[:, ch]
-            ch += 1
-
-        if cnk <= block_size:
-            dset.writeRaw(res[ind, :], typeFlatten="F")
-            dset.writeSamplingFreq(fs)
-            dset.witeFrames(nrecFrame)
-            dset.writeChs(newChs)
-            dset.close()
-        else:
-            dset.appendBrw(output_path, nrecFrame, res[ind, :])
 
-        start = end
+    # the recording is decoded, downsampled and written one window at a time so
+    # peak memory follows window_frames instead of the recording length
+    framesPerChunk = layout["framesPerChunk"]
+    chunks_per_window = max(1, options["window_frames"] // framesPerChunk)
+    nWorkers = options["workers"] or os.cpu_count() or 1
+    if end_frame is None:
+        end_frame = layout["numChunks"] * framesPerChunk
+    end_frame = min(end_frame, layout["numChunks"] * framesPerChunk)
+    if start_frame >= end_frame:
+        # the header can count a few frames more than the chunks decode to
+        raise ValueError(
+            f"{recfileName}: frame {start_frame} is past the last decodable frame "
+            f"{end_frame}, nothing to export"
+        )
+    first_chunk = start_frame // framesPerChunk
+    numChunks = math.ceil(end_frame / framesPerChunk)
 
-    h5.close()
+    window_chunks = split_range(
+        first_chunk,
+        numChunks,
+        math.ceil((numChunks - first_chunk) / chunks_per_window),
+    )
+    # frames of each decoded window that fall inside [start_frame, end_frame)
+    trims = [
+        (
+            max(start_frame - first * framesPerChunk, 0),
+            min(end_frame, last * framesPerChunk) - first * framesPerChunk,
+        )
+        for first, last in window_chunks
+    ]
 
-    totTime = time.time() - s
+    # every task decodes a run of time blocks for all selected channels, so each
+    # coefficient block is read from disk exactly once
+    windows = [
+        [
+            {
+                "kind": "WAV",
+                "recfileName": recfileName,
+                "channel_index": idx_a,
+                "layout": layout,
+                "first": first_chunk,
+                "last": last_chunk,
+                "out_start": (first_chunk - first_window_chunk) * framesPerChunk,
+            }
+            for first_chunk, last_chunk in split_range(
+                first_window_chunk, last_window_chunk, nWorkers
+            )
+        ]
+        for first_window_chunk, last_window_chunk in window_chunks
+    ]
+    add_stage(stats, "probe", time.time() - t)
+
+    with worker_pool(pool, options) as pool:
+        # the output files are created after the workers have started so they do
+        # not inherit their open handles
+        outputs, output_paths = open_outputs(
+            recfileName, chs, chfileInfo, parameters, options, end_frame - start_frame
+        )
+        if not outputs:
+            return 0, output_paths
+        first_window = min(output["first_window"] for output in outputs)
+        resumedFrames = sum(output["nrecFrame"] for output in outputs)
+
+        for window, resampled in enumerate(
+            tqdm(
+                stream_windows(
+                    pool,
+                    windows[first_window:],
+                    trims[first_window:],
+                    outputs,
+                    len(idx_a),
+                    chunks_per_window * framesPerChunk,
+                    nWorkers,
+                    stats,
+                ),
+                initial=first_window,
+                total=len(windows),
+                desc="Downsampling & Export Progress",
+            ),
+            first_window + 1,
+        ):
+            write_window(outputs, window, resampled, ind, stats)
+
+        close_outputs(outputs, newChs, ind, stats)
 
-    return totTime, output_path
+    # the list pipe carried one list per channel and output, frames at the new rate
+    written = sum(output["nrecFrame"] for output in outputs) - resumedFrames
+    stats["pipe_seconds"] = pipe_seconds(
+        written * len(idx_a), max(output["nrecFrame"] for output in outputs)
+    )
+    print_transport_stats(stats)
+
+    return time.time() - s, output_paths
+
+
+def extBW5_RAW(
+    chfileName,
+    recfileName,
+    chfileInfo,
+    parameters,
+    options=None,
+    pool=None,
+    report=None,
+):
+    start_frame, end_frame = time_window(recfileName, chfileInfo, parameters)
+    return extRAW(
+        recfileName,
+        "Well_A1/Raw",
+        chfileInfo,
+        parameters,
+        options,
+        pool,
+        start_frame,
+        end_frame,
+        report,
+    )
 
 
 def file_check(path, filename):
@@ -789,87 +2114,135 @@ def file_check(path, filename):
     return (chfilePath, recfilePath, chfileInfo, parameters, filematch)
 
 
-def run(drive_letter, folder):
-    fileCount = 1
-    os.chdir(drive_letter)
-    for filename in os.listdir(folder):
-        filematch = False
-        if filename.split("_")[-1] == "exportCh.brw":
-            chfileName, recfileName, chfileInfo, parameters, filematch = file_check(
-                folder, filename
-            )
-
-        if (
-            filematch
-            and chfileInfo["Ver"].decode("utf8") == "BW4"
-            and chfileInfo["Typ"].decode("utf8") == "WAV"
-        ):
-            totTime, output_path = extBW4_WAV(
-                chfileName, recfileName, chfileInfo, parameters
-            )
-            print(
-                "\n #",
-                fileCount,
-                " Down Sampled Output File Location: ",
-                output_path,
-                "\n Time to Downsample: ",
-                totTime,
-            )
+def get_extractor(chfileInfo):
+    Ver = chfileInfo["Ver"].decode("utf8")
+    Typ = chfileInfo["Typ"].decode("utf8")
+    if Ver == "BW4" and Typ == "WAV":
+        return extBW4_WAV
+    elif Ver == "BW4" and Typ == "RAW":
+        return extBW4_RAW
+    elif Ver == "BW5" and Typ == "RAW":
+        return extBW5_RAW
+    elif Ver == "BW5" and Typ == "WAV":
+        return extBW5_WAV
+    return None
 
-        elif (
-            filematch
-            and chfileInfo["Ver"].decode("utf8") == "BW4"
-            and chfileInfo["Typ"].decode("utf8") == "RAW"
-        ):
-            totTime, output_path = extBW4_RAW(
-                chfileName, recfileName, chfileInfo, parameters
-            )
-            print(
-                "\n #",
-                fileCount,
-                " Down Sampled Output File Location: ",
-                output_path,
-                "\n Time to Downsample: ",
-                totTime,
-            )
 
-        elif (
-            filematch
-            and chfileInfo["Ver"].decode("utf8") == "BW5"
-            and chfileInfo["Typ"].decode("utf8") == "RAW"
-        ):
-            totTime, output_path = extBW5_WAV(
-                chfileName, recfileName, chfileInfo, parameters
-            )
-            print(
-                "\n #",
-                fileCount,
-                " Down Sampled Output File Location: ",
-                output_path,
-                "\n Time to Downsample: ",
-                totTime,
-            )
+def run(drive_letter, folder, options=None):
+    options = get_export_options(options)
+    os.chdir(drive_letter)
+    batch_start = time.time()
 
-        elif (
-            filematch
-            and chfileInfo["Ver"].decode("utf8") == "BW5"
-            and chfileInfo["Typ"].decode("utf8") == "WAV"
-        ):
-            totTime, output_path = extBW5_WAV(
-                chfileName, recfileName, chfileInfo, parameters
+    jobs, done, failed, files = [], [], [], []
+    for filename in os.listdir(folder):
+        if filename.split("_")[-1] == "exportCh.brw":
+            report = job_report()
+            t = time.time()
+            try:
+                chfileName, recfileName, chfileInfo, parameters, filematch = file_check(
+                    folder, filename
+                )
+            except Exception as e:
+                print("Failed to read: ", filename, "\n Error: ", e)
+                failed.append(os.path.join(folder, filename))
+                add_stage(report, "probe", time.time() - t)
+                files.append(file_report(os.path.join(folder, filename), report))
+                continue
+            add_stage(report, "probe", time.time() - t)
+            if filematch and get_extractor(chfileInfo) is not None:
+                jobs.append((chfileName, recfileName, chfileInfo, parameters, report))
+
+    # the biggest recordings go first so a long file never starts last and
+    # leaves the rest of the pool idle at the end of the batch
+    jobs.sort(key=lambda job: os.path.getsize(job[1]), reverse=True)
+
+    # one pool is kept warm for the whole batch. It is started before any output
+    # file is opened so the workers do not inherit open HDF5 handles.
+    with start_pool(options["workers"]) as pool:
+        for fileCount, (
+            chfileName,
+            recfileName,
+            chfileInfo,
+            parameters,
+            report,
+        ) in enumerate(jobs, 1):
+            extract = get_extractor(chfileInfo)
+            s = time.time()
+            try:
+                totTime, output_paths = extract(
+                    chfileName,
+                    recfileName,
+                    chfileInfo,
+                    parameters,
+                    options,
+                    pool,
+                    report,
+                )
+            except Exception as e:
+                # one bad recording should not cost the rest of the batch
+                print("\n #", fileCount, " Failed: ", recfileName, "\n Error: ", e)
+                traceback.print_exc()
+                failed.append(recfileName)
+                files.append(file_report(recfileName, report, time.time() - s))
+                continue
+
+            done.append(recfileName)
+            files.append(
+                file_report(recfileName, report, time.time() - s, output_paths)
             )
             print(
                 "\n #",
                 fileCount,
                 " Down Sampled Output File Location: ",
-                output_path,
+                ", ".join(output_paths),
                 "\n Time to Downsample: ",
                 totTime,
             )
 
-        fileCount += 1
-
-    return None
+    print(f"\n{len(done)} of {len(done) + len(failed)} files downsampled")
+    for recfileName in failed:
+        print("Failed: ", recfileName)
+
+    batch = batch_report(files, time.time() - batch_start)
+    if options["report"]:
+        with open(os.path.join(folder, options["report"]), "w") as f:
+            json.dump(batch, f, indent=2)
+    if options["report_table"] and files:
+        print()
+        print_stage_table(batch["batch"]["stages"], batch["batch"]["seconds"])
+
+    return done, failed
+
+
+def file_report(recfileName, report, seconds=0.0, output_paths=None):
+    # output_paths is None for a file that failed
+    return {
+        "recording": recfileName,
+        "outputs": output_paths or [],
+        "status": "failed" if output_paths is None else "done",
+        "seconds": seconds + report["stages"]["probe"]["seconds"],
+        "stages": report["stages"],
+        "transport_bytes": report["transport_bytes"],
+        "pipe_seconds_saved": report["pipe_seconds"],
+    }
+
+
+def batch_report(files, seconds):
+    total = job_report()
+    for entry in files:
+        merge_stages(total, entry["stages"])
+    return {
+        "files": files,
+        "batch": {
+            "seconds": seconds,
+            "done": sum(entry["status"] == "done" for entry in files),
+            "failed": sum(entry["status"] == "failed" for entry in files),
+            "stages": total["stages"],
+            "pipe_seconds_saved": sum(
+                entry["pipe_seconds_saved"] or 0.0 for entry in files
+            ),
+        },
+    }
 
 
 if __name__ == "__main__":
@@ -888,8 +2261,13 @@ if __name__ == "__main__":
             drive_letter,
             "\n",
         )
-        run(drive_letter, folder)
-        alert("Downsample completed!")
+        done, failed = run(drive_letter, folder)
+        if failed:
+            alert(
+                f"Downsample finished, {len(failed)} of {len(done) + len(failed)} failed!"
+            )
+        else:
+            alert("Downsample completed!")
     except Exception as e:
         print("Error: ", e)
         alert("Downsample failed!")
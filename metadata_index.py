@@ -0,0 +1,72 @@
+import os
+import pickle
+import sqlite3
+
+# Parsed recording metadata is kept in one SQLite file per user so the GUI and the
+# exporter only open a .brw again when its size or modification time changes
+
+
+def index_path():
+    base = os.environ.get("LOCALAPPDATA") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "ChannelExtract", "metadata_index.sqlite")
+
+
+# bumped whenever a parser starts returning different properties, older entries
+# are then dropped instead of being served with missing keys
+INDEX_VERSION = 3
+
+
+def connect():
+    path = index_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    if connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+        with connection:
+            connection.execute("DROP TABLE IF EXISTS files")
+            connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT, kind TEXT, size INTEGER, mtime REAL, properties BLOB, "
+        "PRIMARY KEY (path, kind))"
+    )
+    return connection
+
+
+def cached_properties(path, kind, read):
+    # kind keeps different views of the same file apart, e.g. "recording" and
+    # "exportCh". read() parses the file and is only called on a miss.
+    path = os.path.normcase(os.path.abspath(path))
+    stat = os.stat(path)
+    try:
+        connection = connect()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Metadata index unavailable, reading {path} directly: {e}")
+        return read()
+
+    try:
+        row = connection.execute(
+            "SELECT size, mtime, properties FROM files WHERE path = ? AND kind = ?",
+            (path, kind),
+        ).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return pickle.loads(row[2])
+
+        properties = read()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (path, kind, stat.st_size, stat.st_mtime, pickle.dumps(properties)),
+            )
+        return properties
+    finally:
+        connection.close()
+
+
+def wav_frame_count(coefsTotalLength, nChannels, coefsChunkLength, compressionLevel):
+    # chunks of the second stored channel that fit in the coefficient stream, each
+    # one expands to coefsChunkLength / 2 * 2^compressionLevel frames
+    blockLength = coefsChunkLength * nChannels
+    numChunks = max(0, -(-(coefsTotalLength - coefsChunkLength) // blockLength))
+    return numChunks * int(coefsChunkLength / 2) * 2**compressionLevel
@@ -0,0 +1,56 @@
+import numpy as np
+from PIL import Image
+
+from byte_cache import ByteCache
+
+# Slice photos are only decoded when a grid draws them, at about the size the grid
+# is shown at. The grids keep mapping coordinates with the original dimensions.
+
+# bytes of decoded images kept for redraws
+CACHE_BYTES = 256 * 2**20
+
+# display sizes are rounded up to this step so a small resize reuses the image
+SIZE_STEP = 256
+
+
+class ImageCache(ByteCache):
+    """Downscaled slice images shared by the input and output grids."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        super().__init__(max_bytes)
+
+    def load(self, path, size):
+        size = -(-max(int(size), 1) // SIZE_STEP) * SIZE_STEP
+        pixels = self.get((path, size))
+        if pixels is None:
+            with Image.open(path) as image:
+                # JPEG decodes straight to a reduced scale, the rest is resampled
+                image.draft("RGB", (size, size))
+                image.thumbnail((size, size))
+                pixels = np.asarray(image)
+            self.put((path, size), pixels)
+        return pixels
+
+
+# one cache for the whole application
+image_cache = ImageCache()
+
+
+class SliceImage:
+    """A slice image file, decoded only when drawn.
+
+    shape is the (height, width, bands) of the original image, read from its
+    header, so it can stand in for the full array wherever grid coordinates are
+    scaled to the image.
+    """
+
+    def __init__(self, path, cache=image_cache):
+        self.path = path
+        self.cache = cache
+        with Image.open(path) as image:
+            width, height = image.size
+            self.shape = (height, width, len(image.getbands()))
+
+    def pixels(self, size):
+        # at most size pixels along the longer side, never larger than the original
+        return self.cache.load(self.path, min(size, max(self.shape[:2])))
@@ -0,0 +1,208 @@
+import json
+import math
+
+import h5py
+import numpy as np
+import pywt
+import scipy.signal
+
+from export_to_brw import getChMap
+
+# Synthetic recordings in the layouts get_recFile_properties reads, so the
+# extractors can be run and timed without real multi-GB files
+
+# frames generated and written per step, bounds the memory of the generator
+BLOCK_FRAMES = 10000
+
+
+class SyntheticSignal:
+    """Band-limited noise in ADC counts, generated block by block.
+
+    The AR(1) filter state is carried across read() calls, so consecutive blocks
+    join into one continuous signal per channel.
+    """
+
+    def __init__(self, nChannels, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.zi = np.zeros((nChannels, 1))
+        self.nChannels = nChannels
+
+    def read(self, nFrames):
+        noise = self.rng.normal(0, 40, size=(self.nChannels, nFrames))
+        data, self.zi = scipy.signal.lfilter(
+            [1.0], [1.0, -0.9], noise, axis=1, zi=self.zi
+        )
+        return data
+
+
+def synthetic_signal(nChannels, nFrames, seed=0):
+    return np.int16(SyntheticSignal(nChannels, seed).read(nFrames))
+
+
+def write_recVars(h5, nFrames, samplingRate):
+    v = "/3BRecInfo/3BRecVars/"
+    h5.create_dataset(v + "NRecFrames", data=[np.int64(nFrames)])
+    h5.create_dataset(v + "SamplingRate", data=[np.float64(samplingRate)])
+    h5.create_dataset(v + "SignalInversion", data=[np.int32(1)])
+    h5.create_dataset(v + "MaxVolt", data=[np.int32(4125)])
+    h5.create_dataset(v + "MinVolt", data=[np.int32(-4125)])
+    h5.create_dataset(v + "BitDepth", data=[np.int32(12)])
+
+
+def write_experimentSettings(h5, samplingRate):
+    settings = {"TimeConverter": {"FrameRate": samplingRate}}
+    h5.create_dataset("ExperimentSettings", data=[json.dumps(settings).encode()])
+    h5.attrs["SamplingRate"] = samplingRate
+
+
+def write_raw_stream(dset, nChannels, nFrames, offset, seed):
+    # frame-interleaved like the recordings, i.e. a flat (frames, channels) array
+    source = SyntheticSignal(nChannels, seed)
+    for start in range(0, nFrames, BLOCK_FRAMES):
+        n = min(BLOCK_FRAMES, nFrames - start)
+        block = np.rint(source.read(n)) + offset
+        dset[start * nChannels : (start + n) * nChannels] = block.T.ravel()
+
+
+def write_BW4_RAW(path, nFrames, samplingRate=17855.5, nChannels=4096, seed=0):
+    with h5py.File(path, "w") as h5:
+        write_recVars(h5, nFrames, samplingRate)
+        h5.create_dataset(
+            "/3BRecInfo/3BMeaStreams/Raw/Chs", data=getChMap()[:nChannels]
+        )
+        dset = h5.create_dataset(
+            "/3BData/Raw", shape=(nFrames * nChannels,), dtype=np.uint16
+        )
+        # BW4 samples are unsigned with the baseline in the middle of the range
+        write_raw_stream(dset, nChannels, nFrames, 2048, seed)
+
+
+def write_BW5_RAW(path, nFrames, samplingRate=20000.0, seed=0):
+    # get_recFile_properties assumes the full 4096 channel chip for BW5
+    with h5py.File(path, "w") as h5:
+        write_experimentSettings(h5, samplingRate)
+        dset = h5.create_dataset("Well_A1/Raw", shape=(nFrames * 4096,), dtype=np.int16)
+        write_raw_stream(dset, 4096, nFrames, 0, seed)
+
+
+def encode_WAV_chunks(frames, compressionLevel):
+    # forward counterpart of reconstruct_WAV_chunks: only the coarsest approximation
+    # and detail bands are kept, rolled the way the decoder undoes it
+    coeffs = pywt.wavedec(
+        frames, "sym7", mode="periodization", level=compressionLevel, axis=-1
+    )
+    approx = np.roll(coeffs[0], 5, axis=-1)
+    details = np.roll(coeffs[1], 5, axis=-1)
+    return np.concatenate([approx, details], axis=-1)
+
+
+def write_WAV_stream(dset, nChannels, nFrames, compressionLevel, chunkLength, seed):
+    coefsChunkLength = math.ceil(chunkLength / pow(2, compressionLevel)) * 2
+    chunkFrames = int(coefsChunkLength / 2) * pow(2, compressionLevel)
+    # the decoder drops 2 frames on each side of a chunk, so neighbouring chunks
+    # are encoded with 4 frames of overlap
+    framesPerChunk = chunkFrames - 4
+    numChunks = nFrames // framesPerChunk
+    chunksPerBlock = max(1, BLOCK_FRAMES // framesPerChunk)
+
+    blockLength = coefsChunkLength * nChannels
+    source = SyntheticSignal(nChannels, seed)
+    buffer = np.zeros((nChannels, 2))
+    generated = 0
+    for first in range(0, numChunks, chunksPerBlock):
+        n = min(chunksPerBlock, numChunks - first)
+        need = n * framesPerChunk + 4 - buffer.shape[1]
+        more = source.read(min(need, nFrames - generated))
+        generated += more.shape[1]
+        # zeros stand in for the frames past the end of the recording
+        buffer = np.concatenate(
+            [buffer, more, np.zeros((nChannels, need - more.shape[1]))], axis=1
+        )
+
+        windows = np.lib.stride_tricks.sliding_window_view(buffer, chunkFrames, axis=1)
+        coefs = encode_WAV_chunks(windows[:, ::framesPerChunk][:, :n], compressionLevel)
+        # (chunks, channels, coefficients) is the on-disk order
+        coefs = np.rint(np.transpose(coefs, (1, 0, 2))).astype(np.int16)
+        dset[first * blockLength : (first + n) * blockLength] = coefs.ravel()
+        buffer = buffer[:, n * framesPerChunk :]
+
+
+def wav_dataset(h5, name, nChannels, nFrames, compressionLevel, chunkLength):
+    coefsChunkLength = math.ceil(chunkLength / pow(2, compressionLevel)) * 2
+    numChunks = nFrames // (int(coefsChunkLength / 2) * pow(2, compressionLevel) - 4)
+    dset = h5.create_dataset(
+        name, shape=(numChunks * coefsChunkLength * nChannels,), dtype=np.int16
+    )
+    dset.attrs["CompressionLevel"] = compressionLevel
+    dset.attrs["DataChunkLength"] = chunkLength
+    return dset
+
+
+def write_BW5_WAV(
+    path, nFrames, samplingRate=20000.0, compressionLevel=2, chunkLength=1024, seed=0
+):
+    with h5py.File(path, "w") as h5:
+        write_experimentSettings(h5, samplingRate)
+        h5.create_dataset("Well_A1/StoredChIdxs", data=np.arange(4096))
+        dset = wav_dataset(
+            h5,
+            "Well_A1/WaveletBasedEncodedRaw",
+            4096,
+            nFrames,
+            compressionLevel,
+            chunkLength,
+        )
+        write_WAV_stream(dset, 4096, nFrames, compressionLevel, chunkLength, seed)
+
+
+def write_BW4_WAV(
+    path,
+    nFrames,
+    samplingRate=17855.5,
+    nChannels=4096,
+    compressionLevel=2,
+    chunkLength=1024,
+    seed=0,
+):
+    with h5py.File(path, "w") as h5:
+        write_recVars(h5, nFrames, samplingRate)
+        h5.create_dataset(
+            "/3BRecInfo/3BMeaStreams/WaveletCoefficients/Chs",
+            data=getChMap()[:nChannels],
+        )
+        dset = wav_dataset(
+            h5,
+            "/3BData/WaveletCoefficients",
+            nChannels,
+            nFrames,
+            compressionLevel,
+            chunkLength,
+        )
+        write_WAV_stream(dset, nChannels, nFrames, compressionLevel, chunkLength, seed)
+
+
+def write_exportCh(
+    path, chs, Ver, Typ, nFrames, samplingRate, newSampling, startTime=0, endTime=0
+):
+    # the fields the exporter reads from the GUI's _exportCh files
+    with h5py.File(path, "w") as h5:
+        v = "/3BRecInfo/3BRecVars/"
+        h5.create_dataset(v + "NRecFrames", data=[np.int64(nFrames)])
+        h5.create_dataset(v + "SamplingRate", data=[np.float64(samplingRate)])
+        h5.create_dataset(
+            v + "NewSampling", data=np.atleast_1d(np.float64(newSampling))
+        )
+        h5.create_dataset(v + "Ver", data=[Ver])
+        h5.create_dataset(v + "Typ", data=[Typ])
+        h5.create_dataset(v + "startTime", data=[np.float64(startTime)])
+        h5.create_dataset(v + "endTime", data=[np.float64(endTime)])
+        h5.create_dataset("/3BRecInfo/3BMeaStreams/Raw/Chs", data=chs)
+
+
+# recording writer, Ver and Typ of each synthetic format
+FORMATS = {
+    "BW4-RAW": (write_BW4_RAW, "BW4", "RAW"),
+    "BW4-WAV": (write_BW4_WAV, "BW4", "WAV"),
+    "BW5-RAW": (write_BW5_RAW, "BW5", "RAW"),
+    "BW5-WAV": (write_BW5_WAV, "BW5", "WAV"),
+}
@@ -0,0 +1,133 @@
+import h5py
+import numpy as np
+
+from byte_cache import ByteCache
+from export_to_brw import (
+    decode_WAV_channel,
+    get_WAV_layout,
+    raw_layout,
+    read_raw_block,
+)
+
+# Single-electrode traces for the GUI preview. Only the requested frames of one
+# channel are read, and they are reduced to a min/max envelope small enough to
+# keep many of them in memory.
+
+# min/max pairs per preview segment, about one per pixel of the panel
+PREVIEW_BINS = 1500
+
+# bytes of preview envelopes kept for electrodes visited again
+CACHE_BYTES = 64 * 2**20
+
+
+class TraceReader:
+    """One open recording, read one channel and a range of frames at a time.
+
+    RAW streams are frame-interleaved, so a channel is a strided read. A
+    contiguous stream is memory mapped and the page cache keeps the frames of
+    the range for the next electrode. WAV recordings store each channel's
+    chunks as short runs, so only those runs are read and decoded.
+    """
+
+    def __init__(self, path, parameters):
+        self.h5 = h5py.File(path, "r")
+        self.raw = None
+        if parameters["Typ"] == "WAV":
+            self.layout = get_WAV_layout(self.h5)
+            return
+
+        dataset = "/3BData/Raw" if parameters["Ver"] == "BW4" else "Well_A1/Raw"
+        self.layout = None
+        self.dset = self.h5[dataset]
+        self.nRecElectrodes = parameters["numRecElectrodes"]
+        memmap = raw_layout(self.dset, self.nRecElectrodes)
+        if memmap is not None:
+            offset, dtype, nFrames = memmap
+            self.raw = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=offset,
+                shape=(nFrames, self.nRecElectrodes),
+            )
+
+    def read(self, channel, first_frame, last_frame):
+        if self.layout is not None:
+            return self.read_WAV(channel, first_frame, last_frame)
+        if self.raw is not None:
+            return np.float32(self.raw[first_frame:last_frame, channel])
+        return np.float32(
+            read_raw_block(
+                self.dset,
+                first_frame,
+                last_frame,
+                self.nRecElectrodes,
+                np.array([channel]),
+            )[:, 0]
+        )
+
+    def read_WAV(self, channel, first_frame, last_frame):
+        # the exporter's decoder, run over the chunks that cover the range
+        framesPerChunk = self.layout["framesPerChunk"]
+        first_chunk = first_frame // framesPerChunk
+        frames = decode_WAV_channel(
+            self.h5,
+            channel,
+            self.layout,
+            first_chunk,
+            -(-last_frame // framesPerChunk),
+        )
+        start = first_frame - first_chunk * framesPerChunk
+        return np.float32(frames[start : start + last_frame - first_frame])
+
+    def close(self):
+        self.raw = None
+        self.h5.close()
+
+
+def envelope(samples, bins=PREVIEW_BINS):
+    # (bins, 2) min/max of equal runs of samples, short traces are kept as they are
+    if len(samples) <= bins:
+        return np.stack([samples, samples], axis=1)
+    edges = np.linspace(0, len(samples), bins + 1).astype(int)[:-1]
+    return np.stack(
+        [np.minimum.reduceat(samples, edges), np.maximum.reduceat(samples, edges)],
+        axis=1,
+    )
+
+
+class SegmentCache(ByteCache):
+    """Envelopes of recently previewed electrodes.
+
+    get() may be called from the GUI thread while load() runs in the preview
+    worker. The file handles are only used by the worker.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        super().__init__(max_bytes)
+        self.readers = {}
+
+    def reader(self, path, parameters):
+        # one recording is open at a time, the one the user has selected
+        if path not in self.readers:
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {path: TraceReader(path, parameters)}
+        return self.readers[path]
+
+    def load(self, key, parameters):
+        # key is (path, channel, first_frame, last_frame)
+        segment = self.get(key)
+        if segment is None:
+            path, channel, first_frame, last_frame = key
+            samples = self.reader(path, parameters).read(
+                channel, first_frame, last_frame
+            )
+            segment = envelope(samples)
+            self.put(key, segment)
+        return segment
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}